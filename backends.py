@@ -0,0 +1,130 @@
+import timeit
+import urllib.parse
+
+from sqlalchemy import create_engine, event, bindparam, case, not_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.pool import QueuePool
+
+import metrics
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long every checkout waits for a connection."""
+
+    def _do_get(self):
+        start = timeit.default_timer()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.db_pool_checkout.observe(timeit.default_timer() - start)
+
+
+class Backend:
+    """Creates the engine of a storage backend and runs the statements that every database
+    writes differently. The rest of the bot only uses portable SQLAlchemy."""
+
+    # Number of database workers the backend supports, None to use the configured one
+    max_workers = None
+
+    def create_engine(self, db_cfg):
+        raise NotImplementedError
+
+    def is_deadlock(self, error) -> bool:
+        """Tells if a DBAPIError means the database aborted the transaction to break a deadlock,
+        so it can be run again."""
+        return False
+
+    def upsert_balances(self, conn, users, amounts: dict, skip_blacklisted: bool):
+        """Adds to the balance of every member id in amounts, members that are not in the table are created.
+        With skip_blacklisted the balance of blacklisted members is left as it is."""
+        raise NotImplementedError
+
+    def upsert_blacklisted(self, conn, users, member_ids, blacklisted: bool):
+        """Sets the blacklisted flag of every member id, members that are not in the table are created."""
+        raise NotImplementedError
+
+
+class MySQLBackend(Backend):
+    def create_engine(self, db_cfg):
+        return create_engine(f'mysql+mysqldb://{db_cfg["user"]}:' + urllib.parse.quote_plus(db_cfg["password"]) + f'@{db_cfg["host"]}/{db_cfg["db"]}',
+                             poolclass=TimedQueuePool, pool_size=db_cfg['pool_size'],
+                             max_overflow=db_cfg['max_overflow'], pool_timeout=db_cfg['pool_timeout'],
+                             pool_recycle=db_cfg['pool_recycle'], pool_pre_ping=db_cfg['pre_ping'])
+
+    def is_deadlock(self, error) -> bool:
+        # ER_LOCK_DEADLOCK, InnoDB rolled back the whole transaction
+        return error.orig.args[0] == 1213
+
+    def upsert_balances(self, conn, users, amounts: dict, skip_blacklisted: bool):
+        stmt = mysql_insert(users).values([{'member_id': member_id, 'balance': amount}
+                                           for member_id, amount in amounts.items()])
+        new_balance = users.c.balance + stmt.inserted.balance
+        if skip_blacklisted:
+            new_balance = case([(users.c.blacklisted, users.c.balance)], else_=new_balance)
+        conn.execute(stmt.on_duplicate_key_update(balance=new_balance))
+
+    def upsert_blacklisted(self, conn, users, member_ids, blacklisted: bool):
+        stmt = mysql_insert(users).values([{'member_id': member_id, 'blacklisted': blacklisted}
+                                           for member_id in member_ids])
+        conn.execute(stmt.on_duplicate_key_update(blacklisted=stmt.inserted.blacklisted))
+
+
+class SQLiteBackend(Backend):
+    """Database in a local file in WAL mode, so readers do not wait for the writer.
+    SQLAlchemy 1.3 has no ON CONFLICT for SQLite, upserts are an INSERT OR IGNORE followed by an UPDATE."""
+
+    def create_engine(self, db_cfg):
+        engine = create_engine(f'sqlite:///{db_cfg["path"]}', connect_args={'check_same_thread': False, 'timeout': 30},
+                               poolclass=TimedQueuePool, pool_size=db_cfg['pool_size'],
+                               max_overflow=db_cfg['max_overflow'], pool_timeout=db_cfg['pool_timeout'])
+        event.listen(engine, 'connect', self.on_connect)
+        return engine
+
+    def on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+    def insert_missing(self, conn, users, member_ids):
+        conn.execute(users.insert().prefix_with('OR IGNORE'),
+                     [{'member_id': member_id, 'balance': 0, 'blacklisted': False, 'company_donations': 0}
+                      for member_id in member_ids])
+
+    def upsert_balances(self, conn, users, amounts: dict, skip_blacklisted: bool):
+        self.insert_missing(conn, users, amounts)
+        stmt = users.update().where(users.c.member_id == bindparam('b_member_id')) \
+            .values(balance=users.c.balance + bindparam('b_amount'))
+        if skip_blacklisted:
+            stmt = stmt.where(not_(users.c.blacklisted))
+        conn.execute(stmt, [{'b_member_id': member_id, 'b_amount': amount} for member_id, amount in amounts.items()])
+
+    def upsert_blacklisted(self, conn, users, member_ids, blacklisted: bool):
+        self.insert_missing(conn, users, member_ids)
+        conn.execute(users.update().where(users.c.member_id.in_(list(member_ids))).values(blacklisted=blacklisted))
+
+
+class MemoryBackend(SQLiteBackend):
+    """SQLite database that lives in memory and is lost on close, for tests and benchmarks.
+    It is a single connection, so the pool hands it to one worker at a time."""
+
+    max_workers = 1
+
+    def create_engine(self, db_cfg):
+        engine = create_engine('sqlite://', connect_args={'check_same_thread': False},
+                               poolclass=TimedQueuePool, pool_size=1, max_overflow=0, pool_recycle=-1)
+        event.listen(engine, 'connect', self.on_connect)
+        return engine
+
+    def on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
+BACKENDS = {
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend,
+    'memory': MemoryBackend,
+}
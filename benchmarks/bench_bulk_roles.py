@@ -0,0 +1,73 @@
+"""Benchmarks the bulk operations on the members of a role against synthetic roles of growing size.
+
+Half of the members of every role are already in the database and half are new, like in a real role.
+--legacy also times the old blacklist-role, which merged the members one by one. Usage, from the
+repository root:
+
+    python -m benchmarks.bench_bulk_roles [--config default_config.ini] [--sizes 1000 5000 20000] [--legacy]
+                                          [--backend memory|sqlite | --configured-database]
+"""
+import argparse
+import asyncio
+import timeit
+
+from benchmarks.bench_economy import FIRST_ID, add_database_arguments, cleanup, load_config, seed
+from cogs.economy import Economy
+from database import StatementCounter
+from tests.fakes import FakeBot
+
+
+def legacy_blacklist_role(economy, member_ids: list):
+    session = economy.create_session()
+    for member_id in member_ids:
+        session.merge(economy.user_model(member_id=member_id, blacklisted=True))
+    session.commit()
+    session.close()
+
+
+async def measure(name: str, db, operation):
+    with StatementCounter(db.engine) as counter:
+        start = timeit.default_timer()
+        await operation()
+        elapsed = timeit.default_timer() - start
+    print(f'{name:24} {elapsed * 1000:10.1f} ms   {counter.count:6d} statements')
+
+
+async def run(args):
+    bot = FakeBot(load_config(args), [])
+    db = bot.db
+    economy = Economy(bot)
+    economy.cog_unload()
+
+    try:
+        for size in args.sizes:
+            cleanup(db)
+            seed(db, size // 2, 0)
+            member_ids = list(range(FIRST_ID, FIRST_ID + size))
+            print(f'role with {size} members')
+
+            if args.legacy:
+                await measure('legacy blacklist-role', db,
+                              lambda: db.run(legacy_blacklist_role, economy, member_ids))
+                await economy.bulk_blacklist(member_ids, False)
+            await measure('blacklist-role', db, lambda: economy.bulk_blacklist(member_ids, True))
+            await measure('blacklist-role-remove', db, lambda: economy.bulk_blacklist(member_ids, False))
+            await measure('add-coins-role', db, lambda: economy.bulk_add_coins(member_ids, 10))
+            await measure('remove-coins-role', db, lambda: economy.bulk_add_coins(member_ids, -10))
+    finally:
+        cleanup(db)
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--legacy', action='store_true', help='also time the old one by one blacklist-role')
+    add_database_arguments(parser)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Measures the cost of deciding whether a message earns the chat coins, comparing the MessageRewardFilter
+with the old on_message path that read the configuration and searched the whitelist for every message.
+
+The messages come from a mix of whitelisted and other channels, short and long, sent by a pool of members.
+Usage, from the repository root:
+
+    python -m benchmarks.bench_chat_filter [--config default_config.ini] [--messages 100000] [--members 2000]
+"""
+import argparse
+import bisect
+import random
+import timeit
+from types import SimpleNamespace
+
+import discord
+
+from chat import MessageRewardFilter
+from coins import Config
+
+
+def legacy_reward_for(cfg, message):
+    if message.author.bot:
+        return 0
+    if message.channel.type != discord.ChannelType.text:
+        return 0
+    whitelisted_channels = cfg['CoinsByChat']['whitelisted_channels']
+    if len(whitelisted_channels) != 0:
+        i = bisect.bisect_left(whitelisted_channels, message.channel.id)
+        if len(whitelisted_channels) > i and whitelisted_channels[i] != message.channel.id:
+            return 0
+    if len(message.content) >= cfg['CoinsByChat']['min_chars']:
+        return cfg['CoinsByChat']['coins_for_message']
+    return 0
+
+
+def fake_messages(cfg, count: int, members: int):
+    rng = random.Random(0)
+    channels = [SimpleNamespace(id=channel_id, type=discord.ChannelType.text)
+                for channel_id in list(cfg['CoinsByChat']['whitelisted_channels']) + list(range(1, 9))]
+    authors = [SimpleNamespace(id=member_id, bot=member_id % 50 == 0) for member_id in range(members)]
+    min_chars = cfg['CoinsByChat']['min_chars']
+    return [SimpleNamespace(author=rng.choice(authors), channel=rng.choice(channels),
+                            content='x' * rng.randint(1, min_chars * 2)) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='default_config.ini')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--members', type=int, default=2000)
+    args = parser.parse_args()
+
+    cfg = Config().load(args.config)
+    messages = fake_messages(cfg, args.messages, args.members)
+
+    def run_legacy():
+        return sum(legacy_reward_for(cfg, message) for message in messages)
+
+    def run_filter(cooldown: float):
+        settings = dict(cfg['CoinsByChat'], cooldown=cooldown)
+        reward_filter = MessageRewardFilter(settings)
+        # One message every millisecond, a thousand messages per second
+        return sum(reward_filter.reward_for(message, i / 1000) for i, message in enumerate(messages))
+
+    assert abs(run_legacy() - run_filter(0)) < 1e-6
+    cases = [('legacy on_message', run_legacy),
+             ('filter, no cooldown', lambda: run_filter(0)),
+             (f'filter, {cfg["CoinsByChat"]["cooldown"]:g}s cooldown', lambda: run_filter(cfg['CoinsByChat']['cooldown']))]
+    for name, case in cases:
+        elapsed = min(timeit.repeat(case, number=1, repeat=5))
+        print(f'{name:28} {elapsed / args.messages * 1e9:8.1f} ns/message   {args.messages / elapsed:12.0f} messages/s'
+              f'   {case():10.1f} coins')
+
+
+if __name__ == '__main__':
+    main()
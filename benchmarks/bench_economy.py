@@ -0,0 +1,172 @@
+"""Benchmarks the hot paths of the Economy cog against a seeded database.
+
+The cog is driven with fake Discord objects, so no connection to Discord is needed. The seeded members and
+companies live in a reserved id range and are deleted at the end, the rest of the database is untouched.
+It runs on an in-memory database unless --configured-database is given.
+Usage, from the repository root:
+
+    python -m benchmarks.bench_economy [--config default_config.ini] [--users 10000] [--companies 50]
+                                       [--voice 200] [--iterations 200] [--only payment top ...]
+                                       [--backend memory|sqlite | --configured-database]
+"""
+import argparse
+import asyncio
+import atexit
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+from sqlalchemy import or_
+
+from coins import Config
+from cogs.economy import Economy
+from database import StatementCounter
+from tests.fakes import FakeBot, FakeGuild, add_voice_channels
+
+FIRST_ID = 9 * 10 ** 18
+COMPANY_PREFIX = 'bench-'
+
+
+def add_database_arguments(parser):
+    """Benchmarks run on a throwaway database unless --configured-database is given."""
+    parser.add_argument('--config', help='default_config.ini, or config.ini with --configured-database')
+    database = parser.add_mutually_exclusive_group()
+    database.add_argument('--backend', choices=['memory', 'sqlite'], default='memory',
+                          help='run on an in-memory database or on a temporary SQLite file (default: memory)')
+    database.add_argument('--configured-database', action='store_true',
+                          help='run on the database of the config, the seeded rows are deleted at the end')
+
+
+def load_config(args):
+    path = args.config or ('config.ini' if args.configured_database else 'default_config.ini')
+    cfg = Config().load(path)
+    if not args.configured_database:
+        cfg['Database']['backend'] = args.backend
+        if args.backend == 'sqlite':
+            directory = tempfile.mkdtemp(prefix='coins-bench-')
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+            cfg['Database']['path'] = os.path.join(directory, 'bench.db')
+    return cfg
+
+
+def seed(db, users: int, companies: int):
+    rng = random.Random(0)
+    company_names = [f'{COMPANY_PREFIX}{i}' for i in range(companies)]
+    with db.engine.begin() as conn:
+        if companies > 0:
+            conn.execute(db.Company.__table__.insert(),
+                         [{'name': name, 'tag': f'B{i}', 'category_id': 0, 'role': 0,
+                           'balance': rng.randint(0, 10000)} for i, name in enumerate(company_names)])
+        for start in range(0, users, 1000):
+            rows = list()
+            for member_id in range(FIRST_ID + start, FIRST_ID + min(start + 1000, users)):
+                company_name = rng.choice(company_names) if companies > 0 and rng.random() < 0.5 else None
+                rows.append({'member_id': member_id, 'balance': rng.randint(0, 10000), 'blacklisted': False,
+                             'company_name': company_name,
+                             'company_donations': rng.randint(0, 500) if company_name is not None else 0})
+            conn.execute(db.User.__table__.insert(), rows)
+    return company_names
+
+
+def cleanup(db):
+    # Entries still buffered in the ledger would be written after the delete
+    db.ledger.flush()
+    transactions = db.Transaction.__table__
+    with db.engine.begin() as conn:
+        conn.execute(transactions.delete().where(or_(transactions.c.member_id >= FIRST_ID,
+                                                     transactions.c.company_name.like(f'{COMPANY_PREFIX}%'))))
+        conn.execute(db.User.__table__.delete().where(db.User.member_id >= FIRST_ID))
+        conn.execute(db.Company.__table__.delete().where(db.Company.name.like(f'{COMPANY_PREFIX}%')))
+
+
+def percentile(samples: list, p: float):
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+async def measure(name: str, db, iterations: int, operation):
+    samples = list()
+    with StatementCounter(db.engine) as counter:
+        start = timeit.default_timer()
+        for i in range(iterations):
+            op_start = timeit.default_timer()
+            await operation(i)
+            samples.append(timeit.default_timer() - op_start)
+        elapsed = timeit.default_timer() - start
+
+    samples.sort()
+    print(f'{name:22} p50 {percentile(samples, 0.5) * 1000:8.2f} ms   p95 {percentile(samples, 0.95) * 1000:8.2f} ms'
+          f'   p99 {percentile(samples, 0.99) * 1000:8.2f} ms   {counter.count / iterations:6.1f} stmt/op'
+          f'   {iterations / elapsed:8.1f} op/s')
+
+
+async def run(args):
+    cfg = load_config(args)
+    guild = FakeGuild()
+    add_voice_channels(cfg, guild, args.voice, first_id=FIRST_ID)
+    bot = FakeBot(cfg, [guild])
+    db = bot.db
+
+    cleanup(db)
+    company_names = seed(db, args.users, args.companies)
+
+    economy = Economy(bot)
+    economy.cog_unload()
+    await economy.refresh_leaderboards()
+
+    rng = random.Random(1)
+    voice_members = [member for channel in guild.voice_channels for member in channel.members]
+
+    def move_voice_member():
+        member = rng.choice(voice_members)
+        member.voice.self_mute = not member.voice.self_mute
+        economy.voice_index.update(member)
+
+    def random_member():
+        return guild.get_member(FIRST_ID + rng.randrange(args.users))
+
+    operations = {
+        'coins_tick': lambda i: economy.coins_tick(guild.id),
+        'add_to_balance': lambda i: economy.add_to_balance(random_member(), 1),
+        'payment': lambda i: economy.payment(random_member(), random_member(), 1),
+        'top': lambda i: economy.top(guild),
+        'refresh_leaderboards': lambda i: economy.refresh_leaderboards(),
+        'company_top_donors': lambda i: economy.company_top_donors(rng.choice(company_names)),
+    }
+
+    print(f'{args.users} users, {args.companies} companies, {args.voice} members in voice')
+    try:
+        for name, operation in operations.items():
+            if args.only and name not in args.only:
+                continue
+            iterations = max(1, args.iterations // 10) if name == 'coins_tick' else args.iterations
+            await measure(name, db, iterations, operation)
+
+        for _ in range(args.iterations):
+            move_voice_member()
+        index_matches = economy.voice_index.verify(bot.guilds)
+        print(f'voice index matches a full scan: {index_matches}')
+        if not index_matches:
+            raise SystemExit('The voice index does not match a full scan')
+    finally:
+        cleanup(db)
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--companies', type=int, default=50)
+    parser.add_argument('--voice', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--only', nargs='*')
+    add_database_arguments(parser)
+    args = parser.parse_args()
+
+    # The cog tasks are bound to the default event loop, the benchmark must run on the same one
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Compares the precompiled MessageCatalog with formatting messages straight from the config.
+
+Usage, from the repository root:
+
+    python -m benchmarks.bench_messages [config file]
+"""
+import sys
+import timeit
+
+from configobj import ConfigObj
+
+from messages import MessageCatalog
+
+CASES = [
+    ('top_embed_line', ('Member', 1200)),
+    ('balance_embed_description_with_donations', (350, 40)),
+    ('services_embed_line', ('Servizio 1', 40, 'Questo servizio apre un canale per gestire la richiesta')),
+    ('not_enough_coins', ()),
+]
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else 'default_config.ini'
+    cfg = ConfigObj(path, encoding='utf8')
+    messages = cfg['Messages']
+    catalog = MessageCatalog(messages)
+
+    def config_path(key, args):
+        return (messages[key] % args).replace('\\n', '\n')
+
+    number = 200000
+    for key, args in CASES:
+        assert config_path(key, args) == catalog.render(key, *args)
+        before = min(timeit.repeat(lambda: config_path(key, args), number=number, repeat=5)) / number
+        after = min(timeit.repeat(lambda: catalog.render(key, *args), number=number, repeat=5)) / number
+        print(f'{key:45} config {before * 1e9:8.1f} ns   catalog {after * 1e9:8.1f} ns   x{before / after:.2f}')
+
+
+if __name__ == '__main__':
+    main()
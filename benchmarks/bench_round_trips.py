@@ -0,0 +1,113 @@
+"""Counts the database round trips of the most used commands: the statements plus the liveness pings
+sent when a connection is checked out of the pool.
+
+Run it once as configured and once with --legacy-ping, which adds back the SELECT 1 that used to run
+on every checkout, to compare the two. Only MySQL pings on checkout, so that needs --configured-database.
+Usage, from the repository root:
+
+    python -m benchmarks.bench_round_trips [--config default_config.ini] [--users 1000] [--iterations 200]
+                                           [--no-pre-ping] [--legacy-ping]
+                                           [--backend memory|sqlite | --configured-database]
+"""
+import argparse
+import asyncio
+import random
+import timeit
+
+from sqlalchemy import event
+
+from benchmarks.bench_economy import FIRST_ID, add_database_arguments, cleanup, load_config, seed, percentile
+from cogs.economy import Economy
+from database import StatementCounter
+from tests.fakes import FakeBot, FakeGuild
+
+
+class PingCounter:
+    """Counts the pings done on checkout, the ones of pool_pre_ping and the legacy SELECT 1."""
+
+    def __init__(self, engine, legacy: bool):
+        self.count = 0
+        do_ping = engine.dialect.do_ping
+
+        def counted_ping(dbapi_connection):
+            self.count += 1
+            return do_ping(dbapi_connection)
+        engine.dialect.do_ping = counted_ping
+
+        if legacy:
+            event.listen(engine, 'checkout', self.legacy_ping)
+
+    def legacy_ping(self, dbapi_con, con_record, con_proxy):
+        self.count += 1
+        cursor = dbapi_con.cursor()
+        cursor.execute('SELECT 1')
+        cursor.close()
+
+
+async def measure(name: str, db, pings: PingCounter, iterations: int, operation):
+    samples = list()
+    pings_before = pings.count
+    with StatementCounter(db.engine) as counter:
+        for i in range(iterations):
+            op_start = timeit.default_timer()
+            await operation(i)
+            samples.append(timeit.default_timer() - op_start)
+
+    samples.sort()
+    ping_count = pings.count - pings_before
+    print(f'{name:16} p50 {percentile(samples, 0.5) * 1000:8.2f} ms   p95 {percentile(samples, 0.95) * 1000:8.2f} ms'
+          f'   {counter.count / iterations:5.1f} stmt/op   {ping_count / iterations:5.1f} ping/op'
+          f'   {(counter.count + ping_count) / iterations:5.1f} round trips/op')
+
+
+async def run(args):
+    cfg = load_config(args)
+    if args.no_pre_ping:
+        cfg['Database']['pre_ping'] = False
+    guild = FakeGuild()
+    bot = FakeBot(cfg, [guild])
+    db = bot.db
+    pings = PingCounter(db.engine, args.legacy_ping)
+
+    cleanup(db)
+    seed(db, args.users, 0)
+
+    economy = Economy(bot)
+    economy.cog_unload()
+
+    rng = random.Random(1)
+
+    def random_member():
+        return guild.get_member(FIRST_ID + rng.randrange(args.users))
+
+    operations = {
+        'saldo': lambda i: economy.get_balance(random_member()),
+        'paga': lambda i: economy.payment(random_member(), random_member(), 1),
+        'add_to_balance': lambda i: economy.add_to_balance(random_member(), 1),
+        'blacklist check': lambda i: db.profiles.get(random_member().id),
+    }
+
+    print(f'pre_ping {cfg["Database"]["pre_ping"]}, legacy ping {args.legacy_ping}, '
+          f'pool_size {cfg["Database"]["pool_size"]}, pool_recycle {cfg["Database"]["pool_recycle"]}')
+    try:
+        for name, operation in operations.items():
+            await measure(name, db, pings, args.iterations, operation)
+    finally:
+        cleanup(db)
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--no-pre-ping', action='store_true', help='disable pool_pre_ping regardless of the config')
+    parser.add_argument('--legacy-ping', action='store_true', help='run a SELECT 1 on every checkout, as before')
+    add_database_arguments(parser)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Shows that the company top donors query depends on the size of the company and not on the users table.
+
+For every total number of users the same company with a fixed number of donors is seeded, and the uncached
+query is timed. Usage, from the repository root:
+
+    python -m benchmarks.bench_top_donors [--config default_config.ini] [--sizes 1000 10000 100000] [--donors 100]
+                                          [--backend memory|sqlite | --configured-database]
+"""
+import argparse
+import asyncio
+import random
+
+from benchmarks.bench_economy import FIRST_ID, COMPANY_PREFIX, add_database_arguments, cleanup, load_config, measure
+from cogs.economy import Economy
+from tests.fakes import FakeBot
+
+COMPANY = f'{COMPANY_PREFIX}donors'
+
+
+def seed(db, users: int, donors: int):
+    rng = random.Random(0)
+    with db.engine.begin() as conn:
+        conn.execute(db.Company.__table__.insert(),
+                     [{'name': COMPANY, 'tag': 'BDON', 'category_id': 0, 'role': 0, 'balance': 0}])
+        for start in range(0, users, 1000):
+            rows = list()
+            for i in range(start, min(start + 1000, users)):
+                in_company = i < donors
+                rows.append({'member_id': FIRST_ID + i, 'balance': rng.randint(0, 10000), 'blacklisted': False,
+                             'company_name': COMPANY if in_company else None,
+                             'company_donations': rng.randint(1, 500) if in_company else 0})
+            conn.execute(db.User.__table__.insert(), rows)
+
+
+async def run(args):
+    bot = FakeBot(load_config(args), [])
+    db = bot.db
+    economy = Economy(bot)
+    economy.cog_unload()
+
+    try:
+        for users in args.sizes:
+            cleanup(db)
+            seed(db, users, args.donors)
+            economy.invalidate_top_donors()
+            print(f'{users} users, {args.donors} donors')
+            await measure('fetch_company_top_donors', db, args.iterations,
+                          lambda i: economy.fetch_company_top_donors(COMPANY))
+            await measure('company_top_donors', db, args.iterations,
+                          lambda i: economy.company_top_donors(COMPANY))
+    finally:
+        cleanup(db)
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--donors', type=int, default=100)
+    parser.add_argument('--iterations', type=int, default=200)
+    add_database_arguments(parser)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
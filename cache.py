@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import profiling
+
+Profile = namedtuple('Profile', ['blacklisted', 'company_name'])
+
+
+class ProfileCache:
+    """Bounded LRU cache with expiration of the member profiles (blacklisted flag and company name),
+    profiles that are not cached are read from the database with the given blocking loader."""
+
+    def __init__(self, db, loader, max_size: int, ttl: float):
+        self.db = db
+        self.loader = loader
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    async def get(self, member_id: int) -> Profile:
+        with self.lock:
+            entry = self.entries.get(member_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(member_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self.generation
+
+        profile = await self.db.run(self.loader, member_id)
+
+        with self.lock:
+            # Do not cache a profile read before an invalidation, it could already be stale
+            if generation == self.generation:
+                self.entries[member_id] = (time.monotonic() + self.ttl, profile)
+                self.entries.move_to_end(member_id)
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return profile
+
+    def invalidate(self, member_ids):
+        with self.lock:
+            self.generation += 1
+            for member_id in member_ids:
+                self.entries.pop(member_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+class RequestCoalescer:
+    """Shares the result of a coroutine between identical requests: a request with the same key made while
+    the coroutine runs, or less than window seconds after it completed, gets the same result instead of
+    running it again. Failed results are never shared."""
+
+    def __init__(self, window: float, max_size: int = 1000):
+        self.window = window
+        self.max_size = max_size
+        self.entries = dict()
+
+    async def run(self, key, factory):
+        """Returns the result of factory(), a coroutine function, shared with the other requests for key."""
+        entry = self.entries.get(key)
+        if entry is not None and (entry[1] is None or entry[1] > time.monotonic()):
+            return await asyncio.shield(entry[0])
+
+        if len(self.entries) >= self.max_size:
+            self.purge()
+        future = asyncio.ensure_future(factory())
+        self.entries[key] = (future, None)
+        future.add_done_callback(lambda done: self.completed(key, done))
+        return await asyncio.shield(future)
+
+    def completed(self, key, future):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] is not future:
+            return
+        if future.cancelled() or future.exception() is not None or self.window <= 0:
+            del self.entries[key]
+        else:
+            self.entries[key] = (future, time.monotonic() + self.window)
+
+    def forget(self, key):
+        """Drops the shared result for key, the next request will run again."""
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is not None:
+            del self.entries[key]
+
+    def purge(self):
+        now = time.monotonic()
+        for key in [key for key, (future, expires_at) in self.entries.items()
+                    if expires_at is not None and expires_at <= now]:
+            del self.entries[key]
+
+
+class RenderCache:
+    """Embeds rendered once from the configuration and served until the configuration changes."""
+
+    def __init__(self):
+        self.builders = dict()
+        self.embeds = dict()
+
+    def register(self, key: str, builder):
+        self.builders[key] = builder
+        self.embeds.pop(key, None)
+
+    def get(self, key: str):
+        embed = self.embeds.get(key)
+        if embed is None:
+            with profiling.span('render'):
+                embed = self.builders[key]()
+            self.embeds[key] = embed
+        return embed
+
+    def render_all(self):
+        for key in self.builders:
+            self.get(key)
+
+    def invalidate(self):
+        self.embeds.clear()
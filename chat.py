@@ -0,0 +1,41 @@
+import time
+
+import discord
+
+
+class MessageRewardFilter:
+    """Decides which messages earn the chat coins. It is built once from the [CoinsByChat] settings,
+    so checking a message does not read the configuration."""
+
+    def __init__(self, settings, max_tracked: int = 10000):
+        self.whitelisted_channels = frozenset(settings['whitelisted_channels'])
+        self.min_chars = settings['min_chars']
+        self.coins_for_message = settings['coins_for_message']
+        self.cooldown = settings['cooldown']
+        self.max_tracked = max_tracked
+
+        self.last_rewards = dict()
+
+    def reward_for(self, message: discord.Message, now: float = None):
+        """Returns the coins earned by the message, 0 if it does not earn any."""
+        if message.author.bot or message.channel.type != discord.ChannelType.text:
+            return 0
+        if self.whitelisted_channels and message.channel.id not in self.whitelisted_channels:
+            return 0
+        if len(message.content) < self.min_chars:
+            return 0
+
+        if self.cooldown > 0:
+            now = time.monotonic() if now is None else now
+            last_reward = self.last_rewards.get(message.author.id)
+            if last_reward is not None and now - last_reward < self.cooldown:
+                return 0
+            if len(self.last_rewards) >= self.max_tracked:
+                self.purge(now)
+            self.last_rewards[message.author.id] = now
+        return self.coins_for_message
+
+    def purge(self, now: float):
+        """Forgets the members whose cooldown is over."""
+        self.last_rewards = {member_id: last_reward for member_id, last_reward in self.last_rewards.items()
+                             if now - last_reward < self.cooldown}
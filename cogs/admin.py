@@ -1,4 +1,4 @@
-import subprocess
+import timeit
 
 import discord
 from discord.ext import commands
@@ -17,25 +17,25 @@ class Admin(commands.Cog):
 
     @commands.command(name='set-coins', usage="{}set-coins <member> <amount>")
     async def set_coins(self, ctx, member: discord.Member, amount: int):
-        self.economy_engine.set_balance(member, amount)
+        await self.economy_engine.set_balance(member, amount)
 
         await self.bot.send_success_embed(ctx, 'set_coins_success', member.display_name, amount)
 
     @commands.command(name='add-coins', usage="{}add-coins <member> <amount>")
     async def add_coins(self, ctx, member: discord.Member, amount: int):
-        new_amount = self.economy_engine.add_to_balance(member, amount)
+        new_amount = await self.economy_engine.add_to_balance(member, amount)
 
         await self.bot.send_success_embed(ctx, 'add_coins_success', amount, member.display_name, new_amount)
 
     @commands.command(name='remove-coins', usage="{}remove-coins <member> <amount>")
     async def remove_coins(self, ctx, member: discord.Member, amount: int):
-        new_amount = self.economy_engine.add_to_balance(member, -amount)
+        new_amount = await self.economy_engine.add_to_balance(member, -amount)
 
         await self.bot.send_success_embed(ctx, 'remove_coins_success', amount, member.display_name, new_amount)
 
     @commands.command(name='set-company-coins', usage="{}set-company-coins <company> <amount>")
     async def set_company_coins(self, ctx, company_name: str, amount: int):
-        new_amount = self.economy_engine.set_company_balance(company_name, amount)
+        new_amount = await self.economy_engine.set_company_balance(company_name, amount)
 
         if new_amount is None:
             await self.bot.send_error_embed(ctx, 'company_not_found')
@@ -44,7 +44,7 @@ class Admin(commands.Cog):
 
     @commands.command(name="user-coins", usage="{}user-coins <member>")
     async def user_coins(self, ctx, member: discord.Member):
-        amount, donated = self.economy_engine.get_balance(member)
+        amount, donated = await self.economy_engine.get_balance(member)
 
         if amount is None:
             await self.bot.send_error_embed(ctx, 'member_not_in_database', member.display_name)
@@ -53,7 +53,7 @@ class Admin(commands.Cog):
 
     @commands.command(name="company-coins", usage="{}company-coins <company>")
     async def company_coins(self, ctx, company_name: str):
-        amount = self.economy_engine.get_company_balance(company_name)
+        amount = await self.economy_engine.get_company_balance(company_name)
 
         if amount is None:
             await self.bot.send_error_embed(ctx, 'company_not_found')
@@ -62,28 +62,69 @@ class Admin(commands.Cog):
 
     @commands.command(usage="{}blacklist <member>")
     async def blacklist(self, ctx, member: discord.Member):
-        self.economy_engine.blacklist(member)
+        await self.economy_engine.blacklist(member)
 
         await self.bot.send_success_embed(ctx, 'blacklist_success', member.display_name)
 
     @commands.command(name='blacklist-remove', usage="{}blacklist-remove <member>")
     async def blacklist_remove(self, ctx, member: discord.Member):
-        self.economy_engine.remove_from_blacklist(member)
+        await self.economy_engine.remove_from_blacklist(member)
 
         await self.bot.send_success_embed(ctx, 'blacklist_remove_success', member.display_name)
 
     @commands.command(name='blacklist-role', usage="{}blacklist-role <role>")
     async def blacklist_role(self, ctx, role: discord.Role):
-        self.economy_engine.blacklist_role(role)
+        progress_message = await self.run_bulk(ctx, role, self.economy_engine.bulk_blacklist, True)
 
-        await self.bot.send_success_embed(ctx, 'blacklist_role_success', role.name)
+        await self.finish_bulk(progress_message, 'blacklist_role_success', role.name)
+
+    @commands.command(name='blacklist-role-remove', usage="{}blacklist-role-remove <role>")
+    async def blacklist_role_remove(self, ctx, role: discord.Role):
+        progress_message = await self.run_bulk(ctx, role, self.economy_engine.bulk_blacklist, False)
+
+        await self.finish_bulk(progress_message, 'blacklist_role_remove_success', role.name)
+
+    @commands.command(name='add-coins-role', usage="{}add-coins-role <role> <amount>")
+    async def add_coins_role(self, ctx, role: discord.Role, amount: int):
+        progress_message = await self.run_bulk(ctx, role, self.economy_engine.bulk_add_coins, amount)
+
+        await self.finish_bulk(progress_message, 'add_coins_role_success', amount, len(role.members), role.name)
+
+    @commands.command(name='remove-coins-role', usage="{}remove-coins-role <role> <amount>")
+    async def remove_coins_role(self, ctx, role: discord.Role, amount: int):
+        progress_message = await self.run_bulk(ctx, role, self.economy_engine.bulk_add_coins, -amount)
+
+        await self.finish_bulk(progress_message, 'remove_coins_role_success', amount, len(role.members), role.name)
+
+    async def run_bulk(self, ctx, role: discord.Role, operation, *args):
+        """Runs a bulk operation on the members of the role, showing its progress in a message
+        that is edited at most once per second. Returns the progress message."""
+        member_ids = [member.id for member in role.members]
+        progress_message = await ctx.send(embed=self.progress_embed(0, len(member_ids)))
+        last_edit = timeit.default_timer()
+
+        async def progress(done: int, total: int):
+            nonlocal last_edit
+            if done < total and timeit.default_timer() - last_edit >= 1:
+                last_edit = timeit.default_timer()
+                await progress_message.edit(embed=self.progress_embed(done, total))
+
+        await operation(member_ids, *args, progress=progress)
+        return progress_message
+
+    def progress_embed(self, done: int, total: int):
+        return discord.Embed(color=discord.Colour.blue(), description=self.bot.get_message('bulk_progress', done, total))
+
+    async def finish_bulk(self, progress_message: discord.Message, message: str, *args):
+        await progress_message.edit(embed=discord.Embed(color=discord.Colour.green(),
+                                                        description=self.bot.get_message(message, *args)))
 
     @commands.command(name='toggle-pay', usage='{}toggle-pay')
     async def toggle_pay(self, ctx):
         pay_enabled = self.bot.cfg['pay_enabled']
         pay_enabled = not pay_enabled
         self.bot.cfg['pay_enabled'] = pay_enabled
-        self.bot.cfg.write()
+        self.bot.save_config()
 
         await self.bot.send_success_embed(ctx, 'pay_toggle_success', pay_enabled)
 
@@ -92,7 +133,7 @@ class Admin(commands.Cog):
         deposit_enabled = self.bot.cfg['deposit_enabled']
         deposit_enabled = not deposit_enabled
         self.bot.cfg['deposit_enabled'] = deposit_enabled
-        self.bot.cfg.write()
+        self.bot.save_config()
 
         await self.bot.send_success_embed(ctx, 'deposit_toggle_success', deposit_enabled)
 
@@ -104,8 +145,48 @@ class Admin(commands.Cog):
     async def give_company_service(self, ctx, member: discord.Member, *, service_name: str):
         await self.bot.get_cog('User').give_company_service(ctx, ctx.guild, member, service_name, True)
 
+    @commands.command(name='verify-coins', usage="{}verify-coins <member>")
+    async def verify_coins(self, ctx, member: discord.Member):
+        entries, replayed, current = await self.bot.db.run(self.bot.db.replay_balance, member.id)
+
+        if abs(replayed - current) < 0.001:
+            await self.bot.send_success_embed(ctx, 'verify_coins_success', member.display_name, entries, current)
+        else:
+            await self.bot.send_error_embed(ctx, 'verify_coins_mismatch', member.display_name, entries,
+                                            replayed, current)
+
+    @commands.command(name='coins-stats', usage="{}coins-stats")
+    async def coins_stats(self, ctx):
+        chat_rewards = self.economy_engine.chat_rewards
+        role_rewards = self.economy_engine.role_rewards
+        profiles = self.bot.db.profiles
+        stats = [self.bot.get_message('stats_pending_rewards', chat_rewards.pending, len(chat_rewards)),
+                 self.bot.get_message('stats_pending_role_rewards', role_rewards.pending, len(role_rewards)),
+                 self.bot.get_message('stats_profile_cache', profiles.hits, profiles.misses, len(profiles)),
+                 self.bot.get_message('stats_pending_ledger', len(self.bot.db.ledger))]
+        for guild_id, (rows, duration) in self.economy_engine.tick_stats.items():
+            guild = self.bot.get_guild(guild_id)
+            stats.append(self.bot.get_message('stats_guild_tick', guild.name if guild else guild_id, rows, duration))
+
+        stats_embed = discord.Embed(color=discord.Colour.blue(), description='\n'.join(stats))
+        await ctx.send(embed=stats_embed)
+
+    @commands.command(name='coins-profile', usage="{}coins-profile")
+    async def coins_profile(self, ctx):
+        profiler = self.bot.profiler
+        if not profiler.running:
+            profiler.start()
+            await self.bot.send_success_embed(ctx, 'profiling_started')
+        else:
+            profile_path, summary_path = profiler.stop()
+            await self.bot.send_success_embed(ctx, 'profiling_stopped', profile_path, summary_path)
+
     @commands.command(name='coins-reload', usage="{}coins-reload")
     async def coins_reload(self, ctx):
-        await self.bot.send_success_embed(ctx, 'reloading')
+        try:
+            elapsed = self.bot.reload_config()
+        except (ValueError, SyntaxError) as ex:
+            await self.bot.send_error_embed(ctx, 'reload_failed', ex)
+            return
 
-        subprocess.call(['service', self.bot.cfg['service_name'], 'restart'])
+        await self.bot.send_success_embed(ctx, 'reload_success', elapsed * 1000)
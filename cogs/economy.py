@@ -1,12 +1,54 @@
+import asyncio
 import logging
+import random
+import threading
 import timeit
 
 import discord
 from discord.ext import commands, tasks
-from sqlalchemy import or_
+from sqlalchemy import select, and_
 from sqlalchemy.orm import Session
 
-from database import Database
+import metrics
+from database import Database, blocking
+from leaderboard import Leaderboard
+from voice import VoiceIndex
+
+# Members written by every statement of the bulk operations on roles
+BULK_CHUNK_SIZE = 1000
+# Seconds a special role reward waits for others to be credited with them in one write
+ROLE_REWARD_DELAY = 2.0
+# Times a leaderboard refresh reads the rows again when balances change during the read
+LEADERBOARD_LOAD_ATTEMPTS = 3
+# Balances read at a time when the top of a guild is not in the leaderboard
+TOP_SCAN_CHUNK_SIZE = 500
+# Donors cached per company, more than shown so that members who left the guild can be skipped
+TOP_DONORS_FETCHED = 25
+
+
+class RewardBuffer:
+    """In-memory accumulator of coins per member, drained and written to the database in batches."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.amounts = dict()
+
+    def __len__(self):
+        return len(self.amounts)
+
+    @property
+    def pending(self):
+        return sum(self.amounts.values())
+
+    def add(self, member_id: int, amount):
+        """Adds amount to the pending coins of the member, returns True if the buffer should be flushed."""
+        self.amounts[member_id] = self.amounts.get(member_id, 0) + amount
+        return len(self.amounts) >= self.max_size
+
+    def drain(self) -> dict:
+        amounts = self.amounts
+        self.amounts = dict()
+        return amounts
 
 
 class Economy(commands.Cog):
@@ -16,331 +58,529 @@ class Economy(commands.Cog):
         self.company_model: Database.Company.__class__ = self.bot.db.Company
         self.special_roles: dict = self.bot.cfg['SpecialRoles']
 
-        self.coins_gain = self.bot.cfg['coins_gain']
-        self.role = self.bot.cfg['role']
-        self.coins_tick.start()
+        self.voice_index = VoiceIndex(lambda guild_id: self.bot.guild_cfg(guild_id, 'role'))
+        self.voice_index.rebuild(self.bot.guilds)
+        self.guild_ticks = dict()
+        self.tick_stats = dict()
+        self.chat_rewards = RewardBuffer(self.bot.cfg['CoinsByChat']['flush_size'])
+        self.role_rewards = RewardBuffer(self.bot.cfg['CoinsByChat']['flush_size'])
+        self.role_flush_scheduled = False
+        self.users_leaderboard = Leaderboard(10, self.bot.cfg['Cache']['leaderboard_capacity'])
+        self.companies_leaderboard = Leaderboard(10, self.bot.cfg['Cache']['leaderboard_capacity'])
+        self.top_donors = dict()
+        self.top_donors_lock = threading.Lock()
+        self.top_donors_generation = 0
+        for guild in self.bot.guilds:
+            self.start_guild_tick(guild.id)
+        self.flush_rewards_loop.change_interval(seconds=self.bot.cfg['CoinsByChat']['flush_interval'])
+        self.flush_rewards_loop.start()
+        self.refresh_leaderboards_loop.change_interval(minutes=self.bot.cfg['Cache']['leaderboard_refresh'])
+        self.refresh_leaderboards_loop.start()
+
+    def apply_config(self):
+        """Picks up the settings of a reloaded configuration."""
+        self.special_roles = self.bot.cfg['SpecialRoles']
+        self.chat_rewards.max_size = self.bot.cfg['CoinsByChat']['flush_size']
+        self.role_rewards.max_size = self.bot.cfg['CoinsByChat']['flush_size']
+        self.flush_rewards_loop.change_interval(seconds=self.bot.cfg['CoinsByChat']['flush_interval'])
+        self.refresh_leaderboards_loop.change_interval(minutes=self.bot.cfg['Cache']['leaderboard_refresh'])
+        # The role needed to earn coins could have changed
+        self.voice_index.rebuild(self.bot.guilds)
+
+    def cog_unload(self):
+        for guild_id in list(self.guild_ticks):
+            self.stop_guild_tick(guild_id)
+        self.flush_rewards_loop.cancel()
+        self.refresh_leaderboards_loop.cancel()
+
+    async def shutdown(self):
+        """Stops the background tasks and writes every pending reward to the database."""
+        self.cog_unload()
+        await self.flush_rewards()
 
     def create_session(self) -> Session:
         return self.bot.db.Session()
 
-    def is_blacklisted(self, member: discord.Member):
-        session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=member.id)
+    async def is_blacklisted(self, member: discord.Member):
+        profile = await self.bot.db.profiles.get(member.id)
+        return profile.blacklisted
+
+    def start_guild_tick(self, guild_id: int):
+        """Starts the voice coins tick of the guild. Every guild has its own loop with a stable offset
+        inside the minute, so that the ticks of different guilds do not all run at the same time.
+        A loop that has stopped is replaced."""
+        tick = self.guild_ticks.get(guild_id)
+        if tick is not None and tick.is_running():
+            return
+
+        offset = random.Random(guild_id).uniform(0, 60)
+
+        async def stagger():
+            await asyncio.sleep(offset)
+
+        tick = tasks.loop(minutes=1.0)(self.coins_tick)
+        tick.before_loop(stagger)
+        tick.start(guild_id)
+        self.guild_ticks[guild_id] = tick
+
+    def stop_guild_tick(self, guild_id: int):
+        tick = self.guild_ticks.pop(guild_id, None)
+        if tick is not None:
+            tick.cancel()
+
+    async def coins_tick(self, guild_id: int):
+        # An exception would stop the loop of the guild for good, the next tick retries instead
+        try:
+            await self.credit_voice_members(guild_id)
+        except Exception:
+            logging.exception('coins_tick of guild %d failed', guild_id)
+
+    async def credit_voice_members(self, guild_id: int):
+        guild = self.bot.get_guild(guild_id)
+        if guild is None or guild.unavailable:
+            return
+        start = timeit.default_timer()
 
-        session.close()
+        coins_gain = self.bot.guild_cfg(guild_id, 'coins_gain')
+        gains = dict()
+        for channel_members in self.voice_index.channels(guild_id):
+            if len(channel_members) > 1:
+                for member_id in channel_members:
+                    gains[member_id] = coins_gain
 
-        if query.count() == 1:
-            return query[0].blacklisted
-        else:
-            return False
+        rows = await self.bulk_add_to_balance(gains, 'voice', skip_blacklisted=True)
 
-    @tasks.loop(minutes=1.0)
-    async def coins_tick(self):
-        start = timeit.default_timer()
-
-        session = self.create_session()
-        for guild in self.bot.guilds:
-            if guild.unavailable:
-                pass
-            for channel in guild.voice_channels:
-                if len(channel.members) < 2:
-                    continue
-                unmuted = list()
-                for member in channel.members:
-                    v = member.voice
-                    if (not v.afk and discord.utils.get(member.roles, id=self.role) is not None
-                            and not (v.deaf or v.mute or v.self_deaf or v.self_mute)):
-                        unmuted.append(member)
-
-                if len(unmuted) > 1:
-                    for member in unmuted:
-                        query = session.query(self.user_model).filter_by(member_id=member.id)
-
-                        new_amount = self.coins_gain
-                        if query.count() == 1:
-                            if not query[0].blacklisted:
-                                new_amount += query[0].balance
-                                query[0].balance = new_amount
-                        else:
-                            user = self.user_model(member_id=member.id, balance=new_amount)
-                            session.add(user)
-
-        session.commit()
         stop = timeit.default_timer()
         tot = stop - start
+        self.tick_stats[guild_id] = (rows, tot)
+        metrics.tick_duration.observe(tot, guild_id)
+        logging.info('coins_tick of guild %d credited %d members in %.3fs', guild_id, rows, tot)
         if tot > 10:
-            logging.warning('coins_tick took longer than 10s')
+            logging.warning('coins_tick of guild %d took longer than 10s', guild_id)
+
+    @tasks.loop(seconds=30.0)
+    async def flush_rewards_loop(self):
+        await self.flush_rewards()
+        await self.bot.db.run(self.bot.db.ledger.flush)
+
+    def add_chat_reward(self, member: discord.Member, amount):
+        """Buffers a chat reward for the member, it will be credited on the next flush."""
+        if self.chat_rewards.add(member.id, amount):
+            asyncio.ensure_future(self.flush_buffer(self.chat_rewards, 'chat'))
+
+    def add_role_reward(self, member_id: int, amount):
+        """Buffers a special role reward, it is credited together with the other rewards
+        given in the next ROLE_REWARD_DELAY seconds."""
+        if self.role_rewards.add(member_id, amount):
+            asyncio.ensure_future(self.flush_buffer(self.role_rewards, 'role'))
+        elif not self.role_flush_scheduled:
+            self.role_flush_scheduled = True
+            asyncio.ensure_future(self.flush_role_rewards_later())
+
+    async def flush_role_rewards_later(self):
+        await asyncio.sleep(ROLE_REWARD_DELAY)
+        self.role_flush_scheduled = False
+        await self.flush_buffer(self.role_rewards, 'role')
+
+    async def flush_rewards(self):
+        await self.flush_buffer(self.chat_rewards, 'chat')
+        await self.flush_buffer(self.role_rewards, 'role')
+
+    async def flush_buffer(self, buffer: RewardBuffer, kind: str):
+        amounts = buffer.drain()
+        if len(amounts) == 0:
+            return
+
+        try:
+            await self.bulk_add_to_balance(amounts, kind)
+        except Exception:
+            logging.exception('Could not flush %d %s rewards, they will be retried', len(amounts), kind)
+            for member_id, amount in amounts.items():
+                buffer.add(member_id, amount)
+
+    @tasks.loop(minutes=10.0)
+    async def refresh_leaderboards_loop(self):
+        await self.refresh_leaderboards()
+
+    @blocking
+    def refresh_leaderboards(self):
+        """Reconciles the in-memory leaderboards with the database."""
+        self.load_leaderboard(self.users_leaderboard, self.user_model, self.user_model.member_id)
+        self.load_leaderboard(self.companies_leaderboard, self.company_model, self.company_model.name)
+        # Members can join or leave a company outside of the bot
+        self.invalidate_top_donors()
+
+    def load_leaderboard(self, leaderboard: Leaderboard, model, key_column):
+        for _ in range(LEADERBOARD_LOAD_ATTEMPTS):
+            generation = leaderboard.generation
+            # Rows read while a balance changed could already be stale, they are read again
+            if leaderboard.load(self.fetch_top_rows(model, key_column, leaderboard.capacity), generation):
+                return
+        logging.warning('Could not reload the %s leaderboard, balances kept changing', model.__tablename__)
+
+    def fetch_top_rows(self, model, key_column, limit: int):
+        session = self.create_session()
+        query = session.query(key_column, model.balance).order_by(model.balance.desc()).limit(limit)
+        result = [(key, balance) for key, balance in query]
+
+        session.close()
+        return result
 
     @commands.Cog.listener()
-    async def on_member_update(self, before: discord.Member, after: discord.Member):
-        if len(before.roles) < len(after.roles):
-            new_role = next(role for role in after.roles if role not in before.roles)
-            if str(new_role.id) in self.special_roles:
-                self.add_to_balance(after, self.special_roles[str(new_role.id)])
-        return
+    async def on_ready(self):
+        # Voice state changes and guilds joined while disconnected from the gateway were not received
+        self.voice_index.rebuild(self.bot.guilds)
+        for guild in self.bot.guilds:
+            self.start_guild_tick(guild.id)
 
-    def set_balance(self, member: discord.Member, amount: int):
-        session = self.create_session()
-        user = self.user_model(member_id=member.id, balance=amount)
-        session.merge(user)
-        session.commit()
-        session.close()
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState,
+                                    after: discord.VoiceState):
+        self.voice_index.update(member)
 
-    def set_company_balance(self, company_name: str, amount: int):
-        session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=company_name)
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        self.voice_index.rebuild(self.bot.guilds)
+        self.start_guild_tick(guild.id)
 
-        if query.count() == 1:
-            query[0].balance = amount
-        else:
-            return None
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.stop_guild_tick(guild.id)
+        self.voice_index.remove_guild(guild.id)
+        self.tick_stats.pop(guild.id, None)
 
-        session.commit()
-        session.close()
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles != after.roles:
+            # Company membership follows the member roles
+            self.bot.db.profiles.invalidate([after.id])
+            self.voice_index.update(after)
+            added_role_ids = {role.id for role in after.roles} - {role.id for role in before.roles}
+            reward = sum(self.special_roles[str(role_id)] for role_id in added_role_ids
+                         if str(role_id) in self.special_roles)
+            if reward != 0:
+                self.add_role_reward(after.id, reward)
+
+    @blocking
+    def set_balance(self, member: discord.Member, amount: int):
+        users = self.user_model.__table__
+        with self.bot.db.engine.begin() as conn:
+            # Adding 0 creates the member if needed and locks its row, the balance cannot change until the commit
+            self.bot.db.upsert_balances(conn, {member.id: 0})
+            old_amount = conn.execute(select([users.c.balance]).where(users.c.member_id == member.id)).scalar()
+            conn.execute(users.update().where(users.c.member_id == member.id).values(balance=amount))
+
+        self.users_leaderboard.update(member.id, amount)
+        # Recorded as a difference, so that it commutes with the changes that are still buffered
+        self.bot.db.ledger.record('admin-set', amount - old_amount, member_id=member.id)
+
+    @blocking
+    def set_company_balance(self, company_name: str, amount: int):
+        companies = self.company_model.__table__
+        with self.bot.db.engine.begin() as conn:
+            # Locks the row of the company, the balance cannot change until the commit
+            lock = conn.execute(companies.update().where(companies.c.name == company_name)
+                                .values(balance=companies.c.balance))
+            if lock.rowcount != 1:
+                return None
+            company = conn.execute(select([companies.c.name, companies.c.balance])
+                                   .where(companies.c.name == company_name)).first()
+            conn.execute(companies.update().where(companies.c.name == company_name).values(balance=amount))
+
+        self.companies_leaderboard.update(company.name, amount)
+        self.bot.db.ledger.record('admin-set', amount - company.balance, company_name=company.name)
         return amount
 
-    def add_to_balance(self, member: discord.Member, amount: int):
-        session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=member.id)
-
-        new_amount = amount
-        if query.count() == 1:
-            new_amount += query[0].balance
-            query[0].balance = new_amount
-        else:
-            user = self.user_model(member_id=member.id, balance=new_amount)
-            session.add(user)
+    @blocking
+    def add_to_balance(self, member: discord.Member, amount: int, kind: str = 'admin'):
+        users = self.user_model.__table__
+        # A relative upsert, so it never overwrites a change made by a tick or a flush at the same time
+        with self.bot.db.engine.begin() as conn:
+            self.bot.db.upsert_balances(conn, {member.id: amount})
+            new_amount = conn.execute(select([users.c.balance]).where(users.c.member_id == member.id)).scalar()
 
-        session.commit()
-        session.close()
+        self.users_leaderboard.update(member.id, new_amount)
+        self.bot.db.ledger.record(kind, amount, member_id=member.id)
         return new_amount
 
-    def get_balance(self, member: discord.Member):
-        session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=member.id)
+    @blocking
+    def bulk_add_to_balance(self, amounts: dict, kind: str, skip_blacklisted: bool = False):
+        """Adds to the balance of every member id in amounts with a single multi-row upsert,
+        returns the number of rows sent to the database."""
+        if len(amounts) == 0:
+            return 0
 
-        session.close()
+        users = self.user_model.__table__
+        # The new balances are read in the same transaction: if the read fails nothing is committed,
+        # so a retried flush cannot credit the same amounts twice
+        with self.bot.db.engine.begin() as conn:
+            self.bot.db.upsert_balances(conn, amounts, skip_blacklisted)
+            rows = conn.execute(select([users.c.member_id, users.c.balance, users.c.blacklisted])
+                                .where(users.c.member_id.in_(list(amounts)))).fetchall()
+
+        self.users_leaderboard.update_many((member_id, balance) for member_id, balance, _ in rows)
+        if skip_blacklisted:
+            blacklisted = {member_id for member_id, _, is_blacklisted in rows if is_blacklisted}
+            amounts = {member_id: amount for member_id, amount in amounts.items() if member_id not in blacklisted}
+        self.bot.db.ledger.record_members(kind, amounts)
+        return len(amounts)
+
+    @blocking
+    def get_balance(self, member: discord.Member):
+        user = self.bot.db.get_user(member.id)
 
-        if query.count() == 1:
-            return query[0].balance, query[0].company_donations
-        else:
+        if user is None:
             return 0, 0
+        return user.balance, user.company_donations
 
+    @blocking
     def get_company_balance(self, company_name: str):
-        session = self.create_session()
-        query = session.query(self.company_model).filter_by(name=company_name)
-
-        session.close()
+        company = self.bot.db.get_company(company_name)
 
-        if query.count() == 1:
-            return query[0].balance
-        else:
+        if company is None:
             return 0
-
-    def blacklist(self, member: discord.Member):
-        session = self.create_session()
-        user = self.user_model(member_id=member.id, blacklisted=True)
-        session.merge(user)
-        session.commit()
-        session.close()
-
-    def remove_from_blacklist(self, member: discord.Member):
-        session = self.create_session()
-        user = self.user_model(member_id=member.id, blacklisted=False)
-        session.merge(user)
-        session.commit()
-        session.close()
-
-    def blacklist_role(self, role: discord.Role):
-        session = self.create_session()
-        for member in role.members:
-            user = self.user_model(member_id=member.id, blacklisted=True)
-            session.merge(user)
-        session.commit()
-        session.close()
-
+        return company.balance
+
+    async def blacklist(self, member: discord.Member):
+        await self.set_blacklisted([member.id], True)
+
+    async def remove_from_blacklist(self, member: discord.Member):
+        await self.set_blacklisted([member.id], False)
+
+    @blocking
+    def set_blacklisted(self, member_ids: list, blacklisted: bool):
+        with self.bot.db.engine.begin() as conn:
+            self.bot.db.upsert_blacklisted(conn, member_ids, blacklisted)
+        self.bot.db.profiles.invalidate(member_ids)
+
+    async def bulk_blacklist(self, member_ids: list, blacklisted: bool = True, progress=None):
+        """Sets the blacklisted flag of all the members with one upsert per chunk, progress is awaited
+        with the number of members done and the total after every chunk."""
+        await self.run_in_chunks(member_ids, lambda chunk: self.set_blacklisted(chunk, blacklisted), progress)
+
+    async def bulk_add_coins(self, member_ids: list, amount: int, kind: str = 'admin', progress=None):
+        """Adds amount to the balance of all the members with one upsert per chunk."""
+        await self.run_in_chunks(member_ids,
+                                 lambda chunk: self.bulk_add_to_balance(dict.fromkeys(chunk, amount), kind), progress)
+
+    async def run_in_chunks(self, member_ids: list, operation, progress):
+        for start in range(0, len(member_ids), BULK_CHUNK_SIZE):
+            chunk = member_ids[start:start + BULK_CHUNK_SIZE]
+            await operation(chunk)
+            if progress is not None:
+                await progress(start + len(chunk), len(member_ids))
+
+    @blocking
     def payment(self, sender: discord.Member, receiver: discord.Member, amount: int):
-        session = self.create_session()
-        query = session.query(self.user_model) \
-            .filter(or_(self.user_model.member_id == sender.id, self.user_model.member_id == receiver.id))
-
-        if query.count() == 2:
-            if query[0].member_id == sender.id:
-                user_sender = query[0]
-                user_receiver = query[1]
-            else:
-                user_receiver = query[0]
-                user_sender = query[1]
-        elif query.count() == 1:
-            if query[0].member_id == sender.id:
-                user_sender = query[0]
-                user_receiver = self.user_model(member_id=receiver.id, balance=0)
-                session.add(user_receiver)
-            else:
-                return -1
-        else:
-            return -1
-
-        if user_sender.balance < amount:
+        balances = self.bot.db.transfer(sender.id, receiver.id, amount)
+        if balances is None:
             return -1
 
-        user_sender.balance -= amount
-        user_receiver.balance += amount
-
-        sender_final_balance = user_sender.balance
-
-        session.commit()
-        session.close()
+        sender_final_balance, receiver_final_balance = balances
+        self.users_leaderboard.update_many([(sender.id, sender_final_balance),
+                                            (receiver.id, receiver_final_balance)])
         return sender_final_balance
 
+    @blocking
     def company_deposit(self, sender: discord.Member, amount: int):
-        session = self.create_session()
-        query = session.query(self.user_model).filter_by(member_id=sender.id)
-
-        if query.count() == 1:
-            user_sender = query[0]
-            if user_sender.balance >= amount:
-                user_sender.company.balance += amount
-
-                user_sender.balance -= amount
-                user_sender.company_donations += amount
-                session.commit()
-                return user_sender.balance
+        result = self.bot.db.deposit(sender.id, amount)
+        if result is None:
+            return -1
 
-        session.close()
-        return -1
+        new_amount, company_name, company_balance = result
+        self.users_leaderboard.update(sender.id, new_amount)
+        self.companies_leaderboard.update(company_name, company_balance)
+        self.invalidate_top_donors(company_name)
+        return new_amount
 
-    def top(self, server: discord.Guild):
-        session = self.create_session()
-        query = session.query(self.user_model).order_by(self.user_model.balance.desc()).limit(10)
+    async def top(self, server: discord.Guild):
+        # The leaderboard holds the richest members of every guild, the ranking only shows the ones of server
+        def in_server(member_id):
+            return server.get_member(member_id) is not None
 
-        session.close()
+        top_users = self.users_leaderboard.top(in_server)
+        if top_users is None and self.users_leaderboard.stale:
+            await self.refresh_leaderboards()
+            top_users = self.users_leaderboard.top(in_server)
+        if top_users is None:
+            # Fewer than 10 members of the server are among the balances held in memory
+            top_users = await self.fetch_guild_top(in_server, self.users_leaderboard.size)
 
         top_embed = discord.Embed(color=discord.colour.Colour.dark_gold(),
                                   title=self.bot.get_message('top_embed_title'))
         description = ""
-        for user in query:
-            member = server.get_member(user.member_id)
-            description += '%s\n' % self.bot.get_message('top_embed_line', member.display_name, user.balance)
+        for member_id, balance in top_users:
+            member = server.get_member(member_id)
+            if member is not None:
+                description += '%s\n' % self.bot.get_message('top_embed_line', member.display_name, balance)
         top_embed.description = description
 
         return top_embed
 
-    def companies_top(self):
-        session = self.create_session()
-        query = session.query(self.company_model).order_by(self.company_model.balance.desc()).limit(10)
-
-        session.close()
+    @blocking
+    def fetch_guild_top(self, in_guild, size: int):
+        """Reads the balances from the highest down until size members pass in_guild."""
+        users = self.user_model.__table__
+        result = list()
+        with self.bot.db.engine.connect() as conn:
+            rows = conn.execution_options(stream_results=True) \
+                .execute(select([users.c.member_id, users.c.balance]).order_by(users.c.balance.desc()))
+            chunk = rows.fetchmany(TOP_SCAN_CHUNK_SIZE)
+            while chunk and len(result) < size:
+                result.extend((member_id, balance) for member_id, balance in chunk if in_guild(member_id))
+                chunk = rows.fetchmany(TOP_SCAN_CHUNK_SIZE)
+            rows.close()
+        return result[:size]
+
+    async def companies_top(self):
+        top_companies = self.companies_leaderboard.top()
+        if top_companies is None:
+            await self.refresh_leaderboards()
+            top_companies = self.companies_leaderboard.top()
+        if top_companies is None:
+            top_companies = await self.bot.db.run(self.fetch_top_rows, self.company_model, self.company_model.name,
+                                                  self.companies_leaderboard.size)
 
         top_embed = discord.Embed(color=discord.colour.Colour.dark_gold(),
                                   title=self.bot.get_message('companies_top_embed_title'))
         description = ""
-        for company in query:
-            description += '%s\n' % self.bot.get_message('companies_top_embed_line', company.name, company.balance)
+        for name, balance in top_companies:
+            description += '%s\n' % self.bot.get_message('companies_top_embed_line', name, balance)
         top_embed.description = description
 
         return top_embed
 
-    def company_top_donors(self, company_name: str):
+    async def company_top_donors(self, company_name: str):
+        top_donors = self.top_donors.get(company_name)
+        if top_donors is None:
+            generation = self.top_donors_generation
+            top_donors = await self.fetch_company_top_donors(company_name)
+            with self.top_donors_lock:
+                # Do not cache donors read before an invalidation, a deposit could have made them stale
+                if generation == self.top_donors_generation:
+                    self.top_donors[company_name] = top_donors
+        return top_donors
+
+    def invalidate_top_donors(self, company_name: str = None):
+        """Drops the cached top donors of the company, or of every company. Safe to call from the database workers."""
+        with self.top_donors_lock:
+            self.top_donors_generation += 1
+            if company_name is None:
+                self.top_donors.clear()
+            else:
+                self.top_donors.pop(company_name, None)
+
+    @blocking
+    def fetch_company_top_donors(self, company_name: str):
         session = self.create_session()
-        query = session.query(self.company_model, self.user_model).filter_by(name=company_name)\
-            .filter(self.user_model.company_donations > 0).order_by(self.user_model.company_donations.desc()).limit(10)
+        query = session.query(self.user_model.member_id, self.user_model.company_donations) \
+            .filter(self.user_model.company_name == company_name, self.user_model.company_donations > 0) \
+            .order_by(self.user_model.company_donations.desc()).limit(TOP_DONORS_FETCHED)
+        result = [(member_id, donated) for member_id, donated in query]
 
         session.close()
-
-        result = list()
-        for q in query:
-            result.append((q[1].member_id, q[1].company_donations))
         return result
 
-    async def buy_service(self, server: discord.Guild, member: discord.Member, service_name: str, force: bool):
-        session = self.create_session()
+    def charge_row(self, key_column, key, cost: int, force: bool):
+        """Charges cost to the balance of the row where key_column is key, with a conditional UPDATE
+        so two concurrent purchases can never spend the same coins. With force nothing is charged.
+        Returns (key, new balance) or None if the row does not exist or its balance is lower than cost."""
+        table = key_column.table
+        with self.bot.db.engine.begin() as conn:
+            if not force:
+                charge = conn.execute(table.update()
+                                      .where(and_(key_column == key, table.c.balance >= cost))
+                                      .values(balance=table.c.balance - cost))
+                if charge.rowcount != 1:
+                    return None
+            return conn.execute(select([key_column, table.c.balance]).where(key_column == key)).first()
+
+    @blocking
+    def charge_balance(self, member_id: int, cost: int, force: bool):
+        charged = self.charge_row(self.user_model.__table__.c.member_id, member_id, cost, force)
+        if charged is None:
+            return -1
+
+        new_amount = charged.balance
+        if not force:
+            self.users_leaderboard.update(member_id, new_amount)
+            self.bot.db.ledger.record('service', -cost, member_id=member_id)
+        return new_amount
+
+    @blocking
+    def charge_company_balance(self, company_name: str, cost: int, force: bool):
+        charged = self.charge_row(self.company_model.__table__.c.name, company_name.lower(), cost, force)
+        if charged is None:
+            return -1
 
+        new_amount = charged.balance
+        if not force:
+            self.companies_leaderboard.update(charged.name, new_amount)
+            self.bot.db.ledger.record('service', -cost, company_name=charged.name)
+        return new_amount
+
+    async def buy_service(self, server: discord.Guild, member: discord.Member, service_name: str, force: bool):
         services = self.bot.cfg['Services']
         cost = services[service_name]['cost']
         notify_to = services[service_name]['notify_to']
         private_channel_name = services[service_name]['private_channel_name']
         role_to_add = services[service_name]['role_to_add']
 
-        query = session.query(self.user_model).filter_by(member_id=member.id)
-        if query.count() == 1:
-            if force or query[0].balance >= cost:
-                new_amount = query[0].balance
-                if not force:
-                    new_amount = query[0].balance - cost
-                    query[0].balance = new_amount
-
-                    session.commit()
-
-                await self.bot.send_success_embed(server.get_channel(notify_to), 'service_buy_notification',
-                                                  member.display_name, service_name)
-
-                if len(private_channel_name) != 0:
-                    overwrites = {
-                        server.default_role: discord.PermissionOverwrite(read_messages=False),
-                        member: discord.PermissionOverwrite(read_messages=True)
-                    }
-                    category = server.get_channel(self.bot.cfg['service_category'])
-                    private_channel = await server.create_text_channel('%s - %s' %
-                                                                       (member.display_name, private_channel_name),
-                                                                       overwrites=overwrites)
-                    if category is None:
-                        await private_channel.edit(position=0)
-                    else:
-                        await private_channel.edit(category=category)
-                    await self.bot.send_success_embed(private_channel, 'service_private_channel',
-                                                      member.mention, service_name)
-                if isinstance(role_to_add, int):
-                    role = server.get_role(role_to_add)
-                    await member.add_roles(role)
-                return new_amount
+        new_amount = await self.charge_balance(member.id, cost, force)
+        if new_amount != -1:
+            await self.bot.send_success_embed(server.get_channel(notify_to), 'service_buy_notification',
+                                              member.display_name, service_name)
+
+            if len(private_channel_name) != 0:
+                overwrites = {
+                    server.default_role: discord.PermissionOverwrite(read_messages=False),
+                    member: discord.PermissionOverwrite(read_messages=True)
+                }
+                category = server.get_channel(self.bot.guild_cfg(server.id, 'service_category'))
+                private_channel = await server.create_text_channel('%s - %s' %
+                                                                   (member.display_name, private_channel_name),
+                                                                   overwrites=overwrites)
+                if category is None:
+                    await private_channel.edit(position=0)
+                else:
+                    await private_channel.edit(category=category)
+                await self.bot.send_success_embed(private_channel, 'service_private_channel',
+                                                  member.mention, service_name)
+            if isinstance(role_to_add, int):
+                role = server.get_role(role_to_add)
+                await member.add_roles(role)
 
-        session.close()
-        return -1
+        return new_amount
 
     async def buy_company_service(self, server: discord.Guild, member: discord.Member,
                                   company_name: str, service_name: str, force: bool):
-        session = self.create_session()
-
         company_services = self.bot.cfg['CompanyServices']
         cost = company_services[service_name]['cost']
         notify_to = company_services[service_name]['notify_to']
         private_channel_name = company_services[service_name]['private_channel_name']
 
-        query = session.query(self.company_model).filter_by(name=company_name.lower())
-        if query.count() == 1:
-            company_buyer = query[0]
-            if force or company_buyer.balance >= cost:
-                new_amount = company_buyer.balance
-                if not force:
-                    new_amount = company_buyer.balance - cost
-                    company_buyer.balance = new_amount
-
-                    session.commit()
-
-                await self.bot.send_success_embed(server.get_channel(notify_to), 'company_service_buy_notification',
-                                                  company_name, service_name)
-
-                if len(private_channel_name) != 0:
-                    # TODO Il canale dovrebbe essere visibile a tutto lo staff della Compagnia, ma non si possono usare
-                    #  i ruoli perchè ora non sono più solo della singola Compagnia
-                    overwrites = {
-                        server.default_role: discord.PermissionOverwrite(read_messages=False),
-                        member: discord.PermissionOverwrite(read_messages=True)
-                    }
-                    admin_mention = member.mention
-                    category = server.get_channel(self.bot.cfg['company_service_category'])
-                    private_channel = await server.create_text_channel('%s - %s' %
-                                                                       (company_name, private_channel_name),
-                                                                       overwrites=overwrites)
-                    if category is None:
-                        await private_channel.edit(position=0)
-                    else:
-                        await private_channel.edit(category=category)
-                    await self.bot.send_success_embed(private_channel, 'service_private_channel',
-                                                      admin_mention, service_name)
-
-                return new_amount
+        new_amount = await self.charge_company_balance(company_name, cost, force)
+        if new_amount != -1:
+            await self.bot.send_success_embed(server.get_channel(notify_to), 'company_service_buy_notification',
+                                              company_name, service_name)
+
+            if len(private_channel_name) != 0:
+                # TODO Il canale dovrebbe essere visibile a tutto lo staff della Compagnia, ma non si possono usare
+                #  i ruoli perchè ora non sono più solo della singola Compagnia
+                overwrites = {
+                    server.default_role: discord.PermissionOverwrite(read_messages=False),
+                    member: discord.PermissionOverwrite(read_messages=True)
+                }
+                admin_mention = member.mention
+                category = server.get_channel(self.bot.guild_cfg(server.id, 'company_service_category'))
+                private_channel = await server.create_text_channel('%s - %s' %
+                                                                   (company_name, private_channel_name),
+                                                                   overwrites=overwrites)
+                if category is None:
+                    await private_channel.edit(position=0)
+                else:
+                    await private_channel.edit(category=category)
+                await self.bot.send_success_embed(private_channel, 'service_private_channel',
+                                                  admin_mention, service_name)
 
-        session.close()
-        return -1
+        return new_amount
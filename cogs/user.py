@@ -1,19 +1,13 @@
-import bisect
-
 import discord
 from discord.ext import commands
 from discord.ext.commands import BadArgument
 
 import cogs.economy as economy
+from cache import RequestCoalescer
+from chat import MessageRewardFilter
 from cogs import companies
 
 
-def binary_search(a, x):
-    i = bisect.bisect_left(a, x)
-    if len(a) > i and a[i] != x:
-        return -1
-
-
 class User(commands.Cog):
     class MemberMentioned(commands.Converter):
         async def convert(self, ctx, argument):
@@ -29,34 +23,39 @@ class User(commands.Cog):
         self.bot = bot
         self.economy_engine: economy.Economy = self.bot.get_cog('Economy')
         self.company_manager: companies.Companies = self.bot.get_cog('Companies')
+        self.coalescer = RequestCoalescer(self.bot.cfg['Cooldowns']['coalesce_window'])
+        self.reward_filter = MessageRewardFilter(self.bot.cfg['CoinsByChat'])
+
+        self.bot.render_cache.register('services', self.render_services)
+        self.bot.render_cache.register('company_services', self.render_company_services)
+        self.bot.render_cache.register('help', lambda: self.render_help(False))
+        self.bot.render_cache.register('help_admin', lambda: self.render_help(True))
+
+    def apply_config(self):
+        # Shared results could hold embeds rendered with the old messages
+        self.coalescer = RequestCoalescer(self.bot.cfg['Cooldowns']['coalesce_window'])
+        self.reward_filter = MessageRewardFilter(self.bot.cfg['CoinsByChat'])
 
     async def cog_check(self, ctx: commands.Context) -> bool:
         is_cmd_channel = True
-        cmd_channel = self.bot.cfg['user_command_channel']
+        cmd_channel = self.bot.guild_cfg(ctx.guild.id, 'user_command_channel')
         if cmd_channel != '' and not ctx.author.guild_permissions.administrator:
             is_cmd_channel = cmd_channel == ctx.channel.id
 
-        if is_cmd_channel and self.economy_engine.is_blacklisted(ctx.author):
+        if is_cmd_channel and await self.economy_engine.is_blacklisted(ctx.author):
             raise self.Blacklisted()
         return is_cmd_channel
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        if message.author.bot:
-            return
-        if message.channel.type != discord.ChannelType.text:
-            return
-        whitelisted_channels = self.bot.cfg['CoinsByChat']['whitelisted_channels']
-        if len(whitelisted_channels) != 0:
-            if binary_search(whitelisted_channels, message.channel.id) == -1:
-                return
-
-        if len(message.content) >= self.bot.cfg['CoinsByChat']['min_chars']:
-            self.economy_engine.add_to_balance(message.author, self.bot.cfg['CoinsByChat']['coins_for_message'])
+        reward = self.reward_filter.reward_for(message)
+        if reward != 0:
+            self.economy_engine.add_chat_reward(message.author, reward)
 
     @commands.command(name="saldo", usage="{}saldo", description="Mostra il tuo saldo")
     async def balance(self, ctx):
-        balance, donated = self.economy_engine.get_balance(ctx.author)
+        balance, donated = await self.coalescer.run(('saldo', ctx.author.id),
+                                                    lambda: self.economy_engine.get_balance(ctx.author))
         user_profile_pic_url = ctx.author.avatar_url_as(size=64)
         description = ""
         if donated > 0:
@@ -73,11 +72,11 @@ class User(commands.Cog):
     @commands.command(name="saldo-compagnia", usage="{}saldo-compagnia",
                       description="Mostra il saldo della tua Compagnia")
     async def company_balance(self, ctx):
-        company_name = self.company_manager.get_company_for(ctx.author)
+        company_name = await self.company_manager.get_company_for(ctx.author)
         if company_name is None:
             await self.bot.send_error_embed(ctx, 'not_in_company')
         else:
-            balance = self.economy_engine.get_company_balance(company_name)
+            balance = await self.economy_engine.get_company_balance(company_name)
             balance_embed = discord.Embed(color=discord.Colour.dark_gold(),
                                           title=f'**{company_name}**',
                                           description=self.bot.get_message('company_balance_embed_description',
@@ -92,7 +91,9 @@ class User(commands.Cog):
         if amount <= 0:
             await self.bot.send_error_embed(ctx, 'pay_incorrect_amount')
         else:
-            new_balance = self.economy_engine.payment(ctx.author, member, amount)
+            new_balance = await self.economy_engine.payment(ctx.author, member, amount)
+            self.coalescer.forget(('saldo', ctx.author.id))
+            self.coalescer.forget(('saldo', member.id))
             if new_balance == -1:
                 await self.bot.send_error_embed(ctx, 'not_enough_coins')
             else:
@@ -107,11 +108,12 @@ class User(commands.Cog):
         if amount <= 0:
             await self.bot.send_error_embed(ctx, 'pay_incorrect_amount')
         else:
-            company_name = self.company_manager.get_company_for(ctx.author)
+            company_name = await self.company_manager.get_company_for(ctx.author)
             if company_name is None:
                 await self.bot.send_error_embed(ctx, 'not_in_company')
             else:
-                new_balance = self.economy_engine.company_deposit(ctx.author, amount)
+                new_balance = await self.economy_engine.company_deposit(ctx.author, amount)
+                self.coalescer.forget(('saldo', ctx.author.id))
                 if new_balance == -1:
                     await self.bot.send_error_embed(ctx, 'not_enough_coins')
                 else:
@@ -120,35 +122,62 @@ class User(commands.Cog):
     @commands.command(name='top-donatori', usage="{}top-donatori",
                       description="Visualizza la classifica dei top 10 donatori della tua Compagnia")
     async def company_top_donors(self, ctx):
-        company_name = self.company_manager.get_company_for(ctx.author)
+        company_name = await self.company_manager.get_company_for(ctx.author)
         if company_name is None:
             await self.bot.send_error_embed(ctx, 'not_in_company')
             return
 
-        top_donors = self.economy_engine.company_top_donors(company_name)
+        top_donors = await self.coalescer.run(('top-donatori', company_name),
+                                              lambda: self.economy_engine.company_top_donors(company_name))
         top_donors_embed = discord.Embed(color=discord.Colour.dark_gold(),
                                          title=self.bot.get_message('company_top_donors_embed_title'))
         description = ""
-        for member_id, donated in top_donors:
-            member_name = ctx.guild.get_member(member_id).display_name
-            description += f"{self.bot.get_message('company_top_donors_embed_line', member_name, donated)}\n"
+        # Donors who left the guild are skipped
+        donors = [(ctx.guild.get_member(member_id), donated) for member_id, donated in top_donors]
+        donors = [(member, donated) for member, donated in donors if member is not None]
+        for member, donated in donors[:10]:
+            description += f"{self.bot.get_message('company_top_donors_embed_line', member.display_name, donated)}\n"
         top_donors_embed.description = description
 
         await ctx.send(embed=top_donors_embed)
 
     @commands.command(usage="{}top", description="Mostra la classifica dei 10 utenti più ricchi")
     async def top(self, ctx):
-        top_embed = self.economy_engine.top(ctx.guild)
+        top_embed = await self.coalescer.run(('top', ctx.guild.id), lambda: self.economy_engine.top(ctx.guild))
         await ctx.send(embed=top_embed)
 
     @commands.command(name='top-compagnie', usage="{}top-compagnie",
                       description="Mostra la classifica delle 10 Compagnie più ricche")
     async def companies_top(self, ctx):
-        companies_top_embed = self.economy_engine.companies_top()
+        companies_top_embed = await self.coalescer.run(('top-compagnie',), self.economy_engine.companies_top)
         await ctx.send(embed=companies_top_embed)
 
     @commands.command(name='servizi', usage="{}servizi", description="Mostra la lista dei servizi acquistabili")
     async def services(self, ctx):
+        await ctx.send(embed=self.bot.render_cache.get('services'))
+
+    @commands.command(name='servizi-compagnie', usage="{}servizi-compagnie",
+                      description="Mostra la lista dei servizi acquistabili dalle Compagnie")
+    async def companies_services(self, ctx):
+        await ctx.send(embed=self.bot.render_cache.get('company_services'))
+
+    @commands.command(name='servizio', usage="{}servizio <servizio>", description="Compra il servizio")
+    async def service(self, ctx, *, service_name):
+        await self.give_user_service(ctx, ctx.guild, ctx.author, service_name, False)
+
+    @commands.command(name='servizio-compagnia', usage="{}servizio-compagnia <servizio>",
+                      description="Compra il servizio per la tua Compagnia")
+    async def company_service(self, ctx, *, service_name):
+        await self.give_company_service(ctx, ctx.guild, ctx.author, service_name, False)
+
+    @commands.command(name='coins', usage="{}coins", description="Mostra questo messaggio di aiuto")
+    async def coins_help(self, ctx):
+        if ctx.author.guild_permissions.administrator:
+            await ctx.send(embed=self.bot.render_cache.get('help_admin'))
+        else:
+            await ctx.send(embed=self.bot.render_cache.get('help'))
+
+    def render_services(self):
         services_embed = discord.Embed(color=discord.Colour.dark_gold(),
                                        title=self.bot.get_message('services_embed_title'))
         services = self.bot.cfg['Services']
@@ -158,13 +187,11 @@ class User(commands.Cog):
             content += '%s\n' % self.bot.get_message('services_embed_line', service_name,
                                                      services[service_name]['cost'],
                                                      services[service_name]['description'])
-        services_embed.description = content[:len(content)]
+        services_embed.description = content
 
-        await ctx.send(embed=services_embed)
+        return services_embed
 
-    @commands.command(name='servizi-compagnie', usage="{}servizi-compagnie",
-                      description="Mostra la lista dei servizi acquistabili dalle Compagnie")
-    async def companies_services(self, ctx):
+    def render_company_services(self):
         company_services_embed = discord.Embed(color=discord.Colour.dark_gold(),
                                                title=self.bot.get_message('company_services_embed_title'))
         company_services = self.bot.cfg['CompanyServices']
@@ -176,19 +203,9 @@ class User(commands.Cog):
                                                      company_services[service_name]['description'])
         company_services_embed.description = content
 
-        await ctx.send(embed=company_services_embed)
+        return company_services_embed
 
-    @commands.command(name='servizio', usage="{}servizio <servizio>", description="Compra il servizio")
-    async def service(self, ctx, *, service_name):
-        await self.give_user_service(ctx, ctx.guild, ctx.author, service_name, False)
-
-    @commands.command(name='servizio-compagnia', usage="{}servizio-compagnia <servizio>",
-                      description="Compra il servizio per la tua Compagnia")
-    async def company_service(self, ctx, *, service_name):
-        await self.give_company_service(ctx, ctx.guild, ctx.author, service_name, False)
-
-    @commands.command(name='coins', usage="{}coins", description="Mostra questo messaggio di aiuto")
-    async def coins_help(self, ctx):
+    def render_help(self, admin: bool):
         help_embed = discord.Embed(color=discord.Colour.blue(), title='__**Comandi Coins**__')
 
         prefix = self.bot.command_prefix
@@ -197,13 +214,13 @@ class User(commands.Cog):
             user_cmd += '`%s` **-** *%s*\n' % (command.usage.format(prefix), command.description)
         help_embed.add_field(name='Ecco la lista dei comandi:', value=user_cmd)
 
-        if ctx.author.guild_permissions.administrator:
+        if admin:
             admin_cmd = ''
             for command in self.bot.get_cog('Admin').get_commands():
                 admin_cmd += '`%s` **-** *%s*\n' % (command.usage.format(prefix), command.description)
             help_embed.add_field(name='Comandi Amministratore:', value=admin_cmd)
 
-        await ctx.send(embed=help_embed)
+        return help_embed
 
     async def give_user_service(self, ctx: commands.Context, server: discord.Guild, member: discord.Member, service_name: str, force: bool):
         services = self.bot.cfg['Services']
@@ -222,7 +239,7 @@ class User(commands.Cog):
             await self.bot.send_error_embed(ctx, 'service_not_found', service_name)
 
     async def give_company_service(self, ctx: commands.Context, server: discord.Guild, member: discord.Member, service_name: str, force: bool):
-        company_name = self.company_manager.get_company_for(member)
+        company_name = await self.company_manager.get_company_for(member)
         if company_name is None:
             await self.bot.send_error_embed(ctx, 'not_in_company')
             return
@@ -1,30 +1,57 @@
+import asyncio
 import logging
 import logging.handlers
-from configobj import ConfigObj
+import timeit
+from configobj import ConfigObj, flatten_errors
 
 import discord
 from discord.ext import commands
 from validate import Validator
 
+from cache import RenderCache
 from cogs import economy, user, admin, companies
 from cogs.user import User
 from database import Database
+from messages import MessageCatalog
+import metrics
+import profiling
 
-logging.basicConfig(level=logging.INFO)
-fh = logging.handlers.RotatingFileHandler('logs/error.log', maxBytes=1000000, backupCount=4)
-fh.setLevel(logging.INFO)
-fh.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s : %(name)s : %(message)s', datefmt='%m-%d %H:%M:%S'))
-logging.getLogger('').addHandler(fh)
+
+def setup_logging():
+    logging.basicConfig(level=logging.INFO)
+    fh = logging.handlers.RotatingFileHandler('logs/error.log', maxBytes=1000000, backupCount=4)
+    fh.setLevel(logging.INFO)
+    fh.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)s : %(name)s : %(message)s',
+                                      datefmt='%m-%d %H:%M:%S'))
+    logging.getLogger('').addHandler(fh)
 
 
 class Config:
     def __init__(self):
         self.cfgspec = ['coins_gain = integer', 'role = integer', 'user_command_channel = integer',
-                        'service_category = integer', 'guild_service_category = integer',
+                        'service_category = integer', 'company_service_category = integer',
                         'governatore_role = integer', 'console_role = integer',
                         'pay_enabled = boolean', 'deposit_enabled = boolean',
+                        '[Database]', 'backend = option(mysql, sqlite, memory, default=mysql)',
+                        'path = string(default=coins.db)', 'workers = integer(min=1, default=4)',
+                        'pool_size = integer(min=1, default=5)', 'max_overflow = integer(min=0, default=5)',
+                        'pool_timeout = float(min=0, default=30)', 'pool_recycle = integer(min=-1, default=3600)',
+                        'pre_ping = boolean(default=True)',
+                        '[Metrics]', 'enabled = boolean(default=False)', 'host = string(default=127.0.0.1)',
+                        'port = integer(min=1, max=65535, default=9108)',
+                        '[Cache]', 'profile_size = integer(min=1, default=10000)',
+                        'profile_ttl = float(min=0, default=300)',
+                        'leaderboard_capacity = integer(min=10, default=50)',
+                        'leaderboard_refresh = float(min=1, default=10)',
                         '[CoinsByChat]', 'coins_for_message = float', 'min_chars = integer',
-                        'whitelisted_channels = sorted_id_list',
+                        'whitelisted_channels = sorted_id_list', 'cooldown = float(min=0, default=10)',
+                        'flush_interval = float(min=1, default=30)', 'flush_size = integer(min=1, default=100)',
+                        '[Guilds]', '[[__many__]]', 'coins_gain = integer', 'role = integer',
+                        'user_command_channel = integer', 'service_category = integer',
+                        'company_service_category = integer', 'governatore_role = integer', 'console_role = integer',
+                        '[Cooldowns]', 'coalesce_window = float(min=0, default=2)',
+                        '[[__many__]]', 'rate = integer(min=1)', 'per = float(min=0)',
+                        'type = option(user, channel, guild, default=user)',
                         '[SpecialRoles]', '__many__ = integer',
                         '[Services]', '[[__many__]]', 'cost = integer', 'notify_to = integer', 'role_to_add = integer',
                         '[CompanyServices]', '[[__many__]]', 'cost = integer', 'notify_to = integer',
@@ -33,9 +60,23 @@ class Config:
             'sorted_id_list': self.sorted_id_list
         }
 
-    def load(self):
-        cfg = ConfigObj('config.ini', configspec=self.cfgspec, encoding='utf8')
-        cfg.validate(Validator(self.checks))
+    def load(self, path: str = 'config.ini', strict: bool = False):
+        """Reads and validates the configuration, with strict a ValueError listing the settings
+        that could not be converted is raised instead of leaving them as strings."""
+        cfg = ConfigObj(path, configspec=self.cfgspec, encoding='utf8')
+        result = cfg.validate(Validator(self.checks), preserve_errors=strict)
+        if strict and result is not True:
+            errors = list()
+            for sections, key, error in flatten_errors(cfg, result):
+                section = cfg
+                for name in sections:
+                    section = section[name]
+                # Missing settings and empty values (used for optional ids) have always been allowed
+                if key is None or error is False or section.get(key) == '':
+                    continue
+                errors.append(f"{'/'.join(sections + [key])}: {error}")
+            if len(errors) != 0:
+                raise ValueError('Invalid settings: ' + ', '.join(errors))
         return cfg
 
     def sorted_id_list(self, value: str):
@@ -49,26 +90,91 @@ class Config:
 class CoinsClient(commands.Bot):
     def __init__(self, **options):
         self.cfg = Config().load()
+        self.messages = MessageCatalog(self.cfg['Messages'])
 
         self.db = None
+        self.database_ready = None
+        self.setting_up = False
+        self.started_at = None
         self.company_staff_roles = {}
+        self.render_cache = RenderCache()
+        self.metrics_server = None
+        self.profiler = profiling.Profiler()
         super().__init__(self.cfg['Prefix'], **options)
+        profiling.time_http_requests(self.http)
 
         self.add_check(self.globally_block_dms)
+        self.before_invoke(self.start_command_timer)
+        self.after_invoke(self.stop_command_timer)
+
+    async def start(self, *args, **kwargs):
+        """Creates the database in a worker thread while the bot logs in and connects to the gateway,
+        on_ready waits for it before loading the cogs."""
+        self.started_at = timeit.default_timer()
+        self.database_ready = self.loop.run_in_executor(None, self.create_database)
+        await super().start(*args, **kwargs)
+
+    def create_database(self):
+        start = timeit.default_timer()
+        database = Database(self)
+        logging.info("Database and schema ready in %.3fs", timeit.default_timer() - start)
+        return database
 
     async def on_ready(self):
-        self.db = Database(self)
+        if self.db is not None:
+            # on_ready fires again after every new gateway session, the bot is already set up
+            self.fetch_roles()
+            logging.info("Reconnected, coins running in {0} servers".format(len(self.guilds)))
+            return
+        if self.setting_up:
+            # A new gateway session started while the first on_ready still waits for the database
+            logging.info("on_ready fired again during the startup, ignored")
+            return
+        self.setting_up = True
+
+        ready_at = timeit.default_timer()
+        try:
+            self.db = await self.database_ready
+        except Exception:
+            logging.exception("Could not set up the database")
+            await self.close()
+            return
+        db_wait = timeit.default_timer() - ready_at
+
+        cogs_start = timeit.default_timer()
         self.load_cogs()
+        self.apply_cooldowns()
         self.fetch_roles()
+        self.render_cache.render_all()
+        cogs_time = timeit.default_timer() - cogs_start
+        await self.start_metrics()
 
         await self.change_presence(activity=discord.Activity(type=discord.ActivityType.listening,
                                                              name=f"{self.command_prefix}coins"))
 
+        logging.info("Startup: gateway ready after %.3fs, waited %.3fs for the database, cogs loaded in %.3fs, "
+                     "%.3fs in total", ready_at - self.started_at, db_wait, cogs_time,
+                     timeit.default_timer() - self.started_at)
         logging.info("Coins loaded in {0} servers".format(len(self.guilds)))
 
+    async def close(self):
+        economy_engine = self.get_cog('Economy')
+        if economy_engine is not None:
+            await economy_engine.shutdown()
+
+        await super().close()
+        if self.profiler.running:
+            self.profiler.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        if self.db is not None:
+            self.db.close()
+
     async def on_command_error(self, ctx, exception):
         if isinstance(exception, (commands.errors.MissingRequiredArgument, commands.errors.TooManyArguments)):
             await self.send_error_embed(ctx, 'incorrect_command_usage', ctx.command.usage.format(self.command_prefix))
+        elif isinstance(exception, commands.errors.CommandOnCooldown):
+            await self.send_error_embed(ctx, 'command_on_cooldown', exception.retry_after)
         elif isinstance(exception, commands.errors.BadArgument):
             await self.send_error_embed(ctx, 'bad_command_arguments')
         elif isinstance(exception, commands.errors.CheckFailure):
@@ -84,20 +190,100 @@ class CoinsClient(commands.Bot):
     async def globally_block_dms(self, ctx):
         return ctx.guild is not None
 
+    async def start_command_timer(self, ctx):
+        ctx.started_at = timeit.default_timer()
+        self.profiler.begin_command(ctx)
+
+    async def stop_command_timer(self, ctx):
+        self.profiler.end_command(ctx)
+        started_at = getattr(ctx, 'started_at', None)
+        if started_at is not None:
+            metrics.command_duration.observe(timeit.default_timer() - started_at, ctx.command.qualified_name)
+
+    async def start_metrics(self):
+        """Starts the metrics exporter, if it is enabled and not already running."""
+        if not self.cfg['Metrics']['enabled'] or self.metrics_server is not None:
+            return
+
+        metrics.gateway_latency.set_function(lambda: self.latency)
+        self.metrics_server = metrics.MetricsServer(self.cfg['Metrics']['host'], self.cfg['Metrics']['port'])
+        await self.metrics_server.start()
+        asyncio.ensure_future(metrics.monitor_event_loop_lag())
+        logging.info("Metrics available on http://%s:%d/metrics", self.cfg['Metrics']['host'],
+                     self.cfg['Metrics']['port'])
+
     def load_cogs(self):
         self.add_cog(companies.Companies(self))
         self.add_cog(economy.Economy(self))
         self.add_cog(user.User(self))
         self.add_cog(admin.Admin(self))
 
+    def apply_cooldowns(self):
+        """Gives every command listed in the [Cooldowns] section its configured cooldown."""
+        for command in self.walk_commands():
+            cooldown = self.cfg['Cooldowns'].get(command.qualified_name)
+            if cooldown is None:
+                command._buckets = commands.CooldownMapping(None)
+            else:
+                command._buckets = commands.CooldownMapping.from_cooldown(
+                    cooldown['rate'], cooldown['per'], getattr(commands.BucketType, cooldown['type']))
+
+    async def on_guild_join(self, guild: discord.Guild):
+        self.fetch_guild_roles(guild)
+
     def fetch_roles(self):
-        self.company_staff_roles['governatore'] = self.guilds[0].get_role(self.cfg['governatore_role'])
-        self.company_staff_roles['console'] = self.guilds[0].get_role(self.cfg['console_role'])
-        if self.company_staff_roles['governatore'] is None or self.company_staff_roles['console'] is None:
-            logging.error("Governatore or Console role not correctly set")
+        for guild in self.guilds:
+            self.fetch_guild_roles(guild)
+
+    def fetch_guild_roles(self, guild: discord.Guild):
+        staff_roles = {
+            'governatore': guild.get_role(self.guild_cfg(guild.id, 'governatore_role')),
+            'console': guild.get_role(self.guild_cfg(guild.id, 'console_role'))
+        }
+        self.company_staff_roles[guild.id] = staff_roles
+        if staff_roles['governatore'] is None or staff_roles['console'] is None:
+            logging.error("Governatore or Console role not correctly set in guild %d", guild.id)
+
+    def reload_config(self):
+        """Reads the configuration again and swaps it in the running bot, returns the time taken in seconds.
+        Raises ValueError and keeps the current configuration if the new one is not valid."""
+        start = timeit.default_timer()
+        cfg = Config().load(self.cfg.filename, strict=True)
+        messages = MessageCatalog(cfg['Messages'])
+
+        # Nothing awaits between here and the end, so no command can see a half reloaded configuration
+        self.cfg = cfg
+        self.messages = messages
+        self.command_prefix = cfg['Prefix']
+        for cog in self.cogs.values():
+            apply_config = getattr(cog, 'apply_config', None)
+            if apply_config is not None:
+                apply_config()
+        self.apply_cooldowns()
+        self.fetch_roles()
+        self.render_cache.invalidate()
+        self.render_cache.render_all()
+
+        elapsed = timeit.default_timer() - start
+        logging.info("Configuration reloaded in %.3fs", elapsed)
+        return elapsed
+
+    def guild_cfg(self, guild_id: int, key: str):
+        """Returns the value of a setting for the guild, from its [Guilds] section if it is overridden there."""
+        guild_section = self.cfg['Guilds'].get(str(guild_id))
+        if guild_section is not None and key in guild_section:
+            return guild_section[key]
+        return self.cfg[key]
+
+    def save_config(self):
+        """Writes the configuration to disk and drops everything rendered from the old one."""
+        self.cfg.write()
+        self.render_cache.invalidate()
+        self.render_cache.render_all()
 
     def get_message(self, message: str, *args):
-        return (self.cfg['Messages'][message] % args).replace('\\n', '\n')
+        with profiling.span('render'):
+            return self.messages.render(message, *args)
 
     async def send_success_embed(self, ctx, message: str, *args):
         embed = discord.Embed(
@@ -112,8 +298,11 @@ class CoinsClient(commands.Bot):
         await ctx.send(embed=embed)
 
 
-intents = discord.Intents.default()
-intents.members = True
+if __name__ == '__main__':
+    setup_logging()
+
+    intents = discord.Intents.default()
+    intents.members = True
 
-bot = CoinsClient(case_insensitive=True, help_command=None, intents=intents)
-bot.run(bot.cfg['Token'])
+    bot = CoinsClient(case_insensitive=True, help_command=None, intents=intents)
+    bot.run(bot.cfg['Token'])
@@ -1,10 +1,26 @@
-import urllib
-import urllib.parse
+import asyncio
+import functools
+import timeit
+from collections import namedtuple
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import Column, create_engine, Boolean, String, BigInteger, Float, ForeignKey, event, exc
+from sqlalchemy import Column, Index, inspect, select, literal, and_, Boolean, String, \
+    BigInteger, Integer, Float, DateTime, ForeignKey, event, exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.pool import Pool
+
+import metrics
+import profiling
+from backends import BACKENDS
+from cache import Profile, ProfileCache
+from ledger import LedgerWriter
+
+UserRecord = namedtuple('UserRecord', ['member_id', 'balance', 'blacklisted', 'company_name', 'company_donations'])
+CompanyRecord = namedtuple('CompanyRecord', ['name', 'tag', 'category_id', 'role', 'faction', 'balance'])
+
+# Times a transaction aborted by a deadlock is run before giving up
+DEADLOCK_ATTEMPTS = 3
 
 
 class Database:
@@ -12,10 +28,17 @@ class Database:
 
     def __init__(self, bot):
         self.bot = bot
-        self.engine = create_engine(f'mysql+mysqldb://{self.bot.cfg["Database"]["user"]}:' + urllib.parse.quote_plus(self.bot.cfg["Database"]["password"]) + f'@{self.bot.cfg["Database"]["host"]}/{self.bot.cfg["Database"]["db"]}')
-        self.Base = declarative_base()
+        db_cfg = self.bot.cfg['Database']
+        self.backend = BACKENDS[db_cfg['backend']]()
+        self.engine = self.backend.create_engine(db_cfg)
+        event.listen(self.engine, 'before_cursor_execute', start_statement_timer)
+        event.listen(self.engine, 'after_cursor_execute', stop_statement_timer)
         self.Session = sessionmaker(bind=self.engine)
-        event.listen(Pool, "checkout", check_connection)
+        self.executor = ThreadPoolExecutor(max_workers=self.backend.max_workers or db_cfg['workers'],
+                                           thread_name_prefix='database')
+        self.ledger = LedgerWriter(self.engine, self.Transaction.__table__)
+        self.profiles = ProfileCache(self, self.load_profile,
+                                     self.bot.cfg['Cache']['profile_size'], self.bot.cfg['Cache']['profile_ttl'])
 
         self.create_tables()
 
@@ -23,15 +46,20 @@ class Database:
         __tablename__ = "users"
 
         member_id = Column(BigInteger, primary_key=True)
-        balance = Column(Float, nullable=False, default=0)
+        balance = Column(Float, nullable=False, default=0, index=True)
         blacklisted = Column(Boolean, nullable=False, default=False)
         company_name = Column(String(50), ForeignKey("companies.name", ondelete="SET NULL", onupdate="CASCADE"))
         company = relationship("Company", back_populates="members")
         company_donations = Column(Float, nullable=False, default=0)
 
+        __table_args__ = (Index('ix_users_company_donations', company_name, company_donations),)
+
         def __repr__(self):
             return f"<User(id='{self.member_id}', balance='{self.balance}')>"
 
+        def to_record(self) -> UserRecord:
+            return UserRecord(self.member_id, self.balance, self.blacklisted, self.company_name, self.company_donations)
+
     class Company(Base):
         __tablename__ = "companies"
 
@@ -46,24 +74,222 @@ class Database:
         def __repr__(self):
             return f"<Company(id='{self.name}', balance='{self.balance}')>"
 
+        def to_record(self) -> CompanyRecord:
+            return CompanyRecord(self.name, self.tag, self.category_id, self.role, self.faction, self.balance)
+
+    class Transaction(Base):
+        __tablename__ = "transactions"
+
+        id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+        created_at = Column(DateTime, nullable=False)
+        member_id = Column(BigInteger, index=True)
+        company_name = Column(String(50), index=True)
+        amount = Column(Float, nullable=False)
+        kind = Column(String(20), nullable=False)
+
+        def __repr__(self):
+            return f"<Transaction(id='{self.id}', kind='{self.kind}', amount='{self.amount}')>"
+
     def create_tables(self):
+        new_ledger = self.Transaction.__tablename__ not in inspect(self.engine).get_table_names()
         self.Base.metadata.create_all(self.engine)
+        self.create_missing_indexes()
+        if new_ledger:
+            self.open_ledger()
+
+    def open_ledger(self):
+        """Records the balances that existed before the ledger, so that replaying it gives the current balances."""
+        users = self.User.__table__
+        companies = self.Company.__table__
+        transactions = self.Transaction.__table__
+        now = datetime.utcnow()
+        with self.engine.begin() as conn:
+            conn.execute(transactions.insert().from_select(
+                ['created_at', 'member_id', 'amount', 'kind'],
+                select([literal(now), users.c.member_id, users.c.balance, literal('set')])))
+            conn.execute(transactions.insert().from_select(
+                ['created_at', 'company_name', 'amount', 'kind'],
+                select([literal(now), companies.c.name, companies.c.balance, literal('set')])))
+
+    def create_missing_indexes(self):
+        """create_all does not add indexes to tables that already exist, so they are created here."""
+        inspector = inspect(self.engine)
+        for table in self.Base.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self.engine)
+
+    def get_user(self, member_id: int):
+        """Returns a detached UserRecord for the member or None if it is not in the database."""
+        session = self.Session()
+        user = session.query(self.User).get(member_id)
+        record = None if user is None else user.to_record()
+        session.close()
+        return record
+
+    def get_company(self, name: str):
+        """Returns a detached CompanyRecord for the company or None if it does not exist."""
+        session = self.Session()
+        company = session.query(self.Company).get(name)
+        record = None if company is None else company.to_record()
+        session.close()
+        return record
+
+    def replay_balance(self, member_id: int):
+        """Replays the ledger of the member, returns (number of entries, replayed balance, current balance)."""
+        self.ledger.flush()
+
+        transactions = self.Transaction.__table__
+        session = self.Session()
+        entries = session.execute(select([transactions.c.kind, transactions.c.amount])
+                                  .where(transactions.c.member_id == member_id)
+                                  .order_by(transactions.c.id)).fetchall()
+        user = session.query(self.User).get(member_id)
+        current = 0 if user is None else user.balance
+        session.close()
+
+        replayed = 0
+        for kind, amount in entries:
+            if kind == 'set':
+                replayed = amount
+            else:
+                replayed += amount
+        return len(entries), replayed, current
+
+    def load_profile(self, member_id: int) -> Profile:
+        session = self.Session()
+        row = session.query(self.User.blacklisted, self.User.company_name).filter_by(member_id=member_id).first()
+        session.close()
+
+        if row is None:
+            return Profile(False, None)
+        return Profile(row.blacklisted, row.company_name)
+
+    def upsert_balances(self, conn, amounts: dict, skip_blacklisted: bool = False):
+        """Adds to the balance of every member id in amounts with a multi-row upsert,
+        members that are not in the database are created."""
+        self.backend.upsert_balances(conn, self.User.__table__, amounts, skip_blacklisted)
+
+    def upsert_blacklisted(self, conn, member_ids, blacklisted: bool):
+        """Sets the blacklisted flag of every member id with a multi-row upsert,
+        members that are not in the database are created."""
+        self.backend.upsert_blacklisted(conn, self.User.__table__, member_ids, blacklisted)
+
+    def run_transaction(self, work):
+        """Runs work(conn) in a transaction and returns its result. If the database aborts the transaction
+        to break a deadlock it is run again from the start, up to DEADLOCK_ATTEMPTS times."""
+        for attempt in range(1, DEADLOCK_ATTEMPTS + 1):
+            try:
+                with self.engine.begin() as conn:
+                    return work(conn)
+            except exc.DBAPIError as error:
+                if attempt == DEADLOCK_ATTEMPTS or not self.backend.is_deadlock(error):
+                    raise
+
+    def transfer(self, sender_id: int, receiver_id: int, amount):
+        """Moves amount coins from the sender to the receiver in one short transaction.
+        The sender is debited with a conditional UPDATE, so concurrent transfers can never overdraw it.
+        Returns the final (sender, receiver) balances or None if the sender does not have enough coins."""
+        users = self.User.__table__
+
+        def move(conn):
+            # Both rows are locked in member_id order first, so two opposite transfers wait for each other
+            # instead of each holding the row the other one needs
+            conn.execute(select([users.c.member_id])
+                         .where(users.c.member_id.in_([sender_id, receiver_id]))
+                         .order_by(users.c.member_id)
+                         .with_for_update()).fetchall()
+            debit = conn.execute(users.update()
+                                 .where(and_(users.c.member_id == sender_id, users.c.balance >= amount))
+                                 .values(balance=users.c.balance - amount))
+            if debit.rowcount != 1:
+                return None
+
+            self.upsert_balances(conn, {receiver_id: amount})
+            return dict(conn.execute(select([users.c.member_id, users.c.balance])
+                                     .where(users.c.member_id.in_([sender_id, receiver_id]))).fetchall())
+
+        balances = self.run_transaction(move)
+        if balances is None:
+            return None
+
+        self.ledger.record('payment', -amount, member_id=sender_id)
+        self.ledger.record('payment', amount, member_id=receiver_id)
+        return balances[sender_id], balances[receiver_id]
+
+    def deposit(self, member_id: int, amount):
+        """Moves amount coins from the member to the bank of its company in one short transaction.
+        Returns the final (member balance, company name, company balance) or None if the member
+        is not in a company or does not have enough coins."""
+        users = self.User.__table__
+        companies = self.Company.__table__
+        with self.engine.begin() as conn:
+            debit = conn.execute(users.update()
+                                 .where(and_(users.c.member_id == member_id, users.c.balance >= amount,
+                                             users.c.company_name.isnot(None)))
+                                 .values(balance=users.c.balance - amount,
+                                         company_donations=users.c.company_donations + amount))
+            if debit.rowcount != 1:
+                return None
+
+            user = conn.execute(select([users.c.balance, users.c.company_name])
+                                .where(users.c.member_id == member_id)).first()
+            conn.execute(companies.update()
+                         .where(companies.c.name == user.company_name)
+                         .values(balance=companies.c.balance + amount))
+            company_balance = conn.execute(select([companies.c.balance])
+                                           .where(companies.c.name == user.company_name)).scalar()
+
+        self.ledger.record('deposit', -amount, member_id=member_id)
+        self.ledger.record('deposit', amount, company_name=user.company_name)
+        return user.balance, user.company_name, company_balance
+
+    async def run(self, func, *args, **kwargs):
+        """Runs a blocking function on the database worker pool and waits for its result
+        without blocking the event loop."""
+        loop = asyncio.get_event_loop()
+        with profiling.span('db'):
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.ledger.flush()
+        self.engine.dispose()
+
+
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_start', list()).append(timeit.default_timer())
+
+
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    metrics.db_statements.inc()
+    metrics.db_statement_duration.observe(timeit.default_timer() - conn.info['statement_start'].pop())
+
+
+class StatementCounter:
+    """Context manager counting the statements sent to the database by an engine while it is active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self.engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
 
+def blocking(func):
+    """Decorator for cog methods that do synchronous database I/O: the decorated method becomes
+    a coroutine that runs on the bot database worker pool."""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        return await self.bot.db.run(func, self, *args, **kwargs)
+    return wrapper
 
-@event.listens_for(Pool, "checkout")
-def check_connection(dbapi_con, con_record, con_proxy):
-    """Listener for Pool checkout events that pings every connection before using.
-    Implements pessimistic disconnect handling strategy. See also:
-    http://docs.sqlalchemy.org/en/rel_0_8/core/pooling.html#disconnect-handling-pessimistic"""
-
-    cursor = dbapi_con.cursor()
-    try:
-        cursor.execute("SELECT 1")  # could also be dbapi_con.ping(),
-    except exc.OperationalError as ex:
-        if ex.args[0] in (2006,   # MySQL server has gone away
-                          2013,   # Lost connection to MySQL server during query
-                          2055):  # Lost connection to MySQL server at '%s', system error: %d
-            # caught by pool, which will retry with a new connection
-            raise exc.DisconnectionError()
-        else:
-            raise
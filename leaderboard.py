@@ -0,0 +1,80 @@
+import threading
+
+
+class Leaderboard:
+    """Exact ranking of the highest balances kept in memory and updated as balances change.
+
+    It holds up to `capacity` entries and the invariant that every balance not held is lower or equal
+    than `floor`, which in turn is lower or equal than every balance held. When updates shrink it below
+    `size` entries it becomes stale and must be loaded again from the database.
+
+    Every update bumps `generation`, so that rows read from the database while balances changed are not loaded."""
+
+    def __init__(self, size: int, capacity: int):
+        self.size = size
+        self.capacity = max(size, capacity)
+
+        self.entries = dict()
+        self.floor = None
+        self.complete = False
+        self.loaded = False
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def load(self, rows, generation: int = None):
+        """Replaces the content with rows, a list of (key, balance) ordered by balance and limited to capacity.
+        generation is the value of `generation` read before the rows: if there were updates since then
+        the rows are not loaded. Returns True if they were."""
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return False
+            self.entries = dict(rows)
+            self.complete = len(rows) < self.capacity
+            self.floor = None if self.complete else min(self.entries.values())
+            self.loaded = True
+            return True
+
+    def update(self, key, balance):
+        with self.lock:
+            self._update(key, balance)
+
+    def update_many(self, rows):
+        with self.lock:
+            for key, balance in rows:
+                self._update(key, balance)
+
+    def _update(self, key, balance):
+        self.generation += 1
+        if not self.loaded:
+            return
+
+        if key in self.entries:
+            if self.floor is not None and balance < self.floor:
+                # Someone that is not held could now be richer, keep only what is certainly in the ranking
+                del self.entries[key]
+            else:
+                self.entries[key] = balance
+        elif self.floor is None or balance > self.floor:
+            self.entries[key] = balance
+            if len(self.entries) > self.capacity:
+                lowest = min(self.entries, key=self.entries.get)
+                self.floor = self.entries.pop(lowest)
+                self.complete = False
+
+    @property
+    def stale(self):
+        return not self.loaded or (not self.complete and len(self.entries) < self.size)
+
+    def top(self, keep=None):
+        """Returns the first `size` (key, balance) pairs ordered by balance, or None if the leaderboard is stale.
+        keep, if given, filters the keys. If fewer than `size` held keys pass it and balances that are not held
+        could, the ranking is not known and None is returned too."""
+        with self.lock:
+            if self.stale:
+                return None
+            ranking = sorted(self.entries.items(), key=lambda entry: entry[1], reverse=True)
+            if keep is not None:
+                ranking = [entry for entry in ranking if keep(entry[0])]
+                if len(ranking) < self.size and not self.complete:
+                    return None
+            return ranking[:self.size]
@@ -0,0 +1,54 @@
+import logging
+import threading
+from datetime import datetime
+
+
+class LedgerWriter:
+    """Buffers every balance change in memory and appends them to the transactions table with
+    one multi-row INSERT per flush, so recording a change never adds a round trip to a command."""
+
+    def __init__(self, engine, table, chunk_size: int = 1000):
+        self.engine = engine
+        self.table = table
+        self.chunk_size = chunk_size
+
+        self.entries = list()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, kind: str, amount, member_id: int = None, company_name: str = None):
+        """Records a change of amount coins, kind 'set' entries record the new balance instead.
+        Entries are written by a later flush and not in commit order, so only changes that commute belong here:
+        a balance set by an admin is recorded as the difference, with kind 'admin-set'."""
+        entry = {'created_at': datetime.utcnow(), 'member_id': member_id, 'company_name': company_name,
+                 'amount': amount, 'kind': kind}
+        with self.lock:
+            self.entries.append(entry)
+
+    def record_members(self, kind: str, amounts: dict):
+        created_at = datetime.utcnow()
+        entries = [{'created_at': created_at, 'member_id': member_id, 'company_name': None,
+                    'amount': amount, 'kind': kind} for member_id, amount in amounts.items()]
+        with self.lock:
+            self.entries.extend(entries)
+
+    def flush(self):
+        """Writes the buffered entries, returns how many were written. Blocking."""
+        with self.lock:
+            entries = self.entries
+            self.entries = list()
+        if len(entries) == 0:
+            return 0
+
+        try:
+            with self.engine.begin() as conn:
+                for start in range(0, len(entries), self.chunk_size):
+                    conn.execute(self.table.insert().values(entries[start:start + self.chunk_size]))
+        except Exception:
+            logging.exception('Could not write %d ledger entries, they will be retried', len(entries))
+            with self.lock:
+                self.entries[:0] = entries
+            return 0
+        return len(entries)
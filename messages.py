@@ -0,0 +1,106 @@
+import re
+
+# Number of arguments passed to every message of the [Messages] config section
+MESSAGE_ARGS = {
+    'balance_embed_description': 1,
+    'balance_embed_description_with_donations': 2,
+    'company_balance_embed_description': 1,
+    'top_embed_title': 0,
+    'top_embed_line': 2,
+    'companies_top_embed_title': 0,
+    'companies_top_embed_line': 2,
+    'services_embed_title': 0,
+    'services_embed_line': 3,
+    'company_services_embed_title': 0,
+    'company_services_embed_line': 3,
+    'company_top_donors_embed_title': 0,
+    'company_top_donors_embed_line': 2,
+
+    'set_coins_success': 2,
+    'add_coins_success': 3,
+    'remove_coins_success': 3,
+    'show_member_coins': 2,
+    'show_company_coins': 2,
+    'member_not_in_database': 1,
+    'blacklist_success': 1,
+    'blacklist_remove_success': 1,
+    'service_buy_notification': 2,
+    'company_service_buy_notification': 2,
+    'blacklist_role_success': 1,
+    'blacklist_role_remove_success': 1,
+    'add_coins_role_success': 3,
+    'remove_coins_role_success': 3,
+    'bulk_progress': 2,
+    'pay_toggle_success': 1,
+    'deposit_toggle_success': 1,
+    'reload_success': 1,
+    'reload_failed': 1,
+    'stats_pending_rewards': 2,
+    'stats_pending_role_rewards': 2,
+    'stats_profile_cache': 3,
+    'stats_pending_ledger': 1,
+    'stats_guild_tick': 3,
+    'verify_coins_success': 3,
+    'verify_coins_mismatch': 4,
+    'profiling_started': 0,
+    'profiling_stopped': 2,
+    'command_on_cooldown': 1,
+
+    'no_permissions': 0,
+    'pay_not_enabled': 0,
+    'deposit_not_enabled': 0,
+    'not_enough_coins': 0,
+    'blacklisted': 0,
+    'pay_incorrect_amount': 0,
+    'pay_success': 3,
+    'deposit_success': 2,
+    'service_buy_success': 2,
+    'service_private_channel': 2,
+    'service_not_found': 1,
+
+    'not_in_company': 0,
+    'not_company_admin': 0,
+    'company_not_found': 0,
+    'set_company_coins_success': 2,
+
+    'incorrect_command_usage': 1,
+    'bad_command_arguments': 0,
+}
+
+PLACEHOLDER = re.compile(r'%[-#0 +]*\d*(?:\.\d+)?[diouxXeEfFgGcrsa]')
+
+
+class MessageCatalog:
+    """Messages of the [Messages] config section, unescaped and validated once when loaded."""
+
+    def __init__(self, messages):
+        self.templates = dict()
+
+        errors = list()
+        for key, template in messages.items():
+            if isinstance(template, str):
+                self.templates[key] = template.replace('\\n', '\n')
+            else:
+                errors.append(f"'{key}' contains commas and must be quoted")
+        for key, expected in MESSAGE_ARGS.items():
+            if key not in messages:
+                errors.append(f"'{key}' is missing")
+                continue
+            if key not in self.templates:
+                continue
+
+            template = self.templates[key]
+            found = len(PLACEHOLDER.findall(template.replace('%%', '')))
+            if found != expected:
+                errors.append(f"'{key}' has {found} arguments instead of {expected}")
+                continue
+            try:
+                template % ((0,) * expected)
+            except (TypeError, ValueError) as ex:
+                errors.append(f"'{key}' is not a valid message: {ex}")
+
+        if len(errors) != 0:
+            raise ValueError('Invalid [Messages] configuration: ' + ', '.join(errors))
+
+    def render(self, key: str, *args):
+        return self.templates[key] % args
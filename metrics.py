@@ -0,0 +1,144 @@
+import asyncio
+import threading
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, description: str, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = dict()
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def format_labels(self, values, extra=None):
+        pairs = list(zip(self.labels, values))
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join('%s="%s"' % (name, str(value).replace('"', '\\"')) for name, value in pairs) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            samples = list(self.values.items())
+        for label_values, value in samples:
+            lines.append(f'{self.name}{self.format_labels(label_values)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str, labels=()):
+        super().__init__(name, description, labels)
+        self.function = None
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def set_function(self, function):
+        """Reads the value from function every time the metrics are collected."""
+        self.function = function
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts, total, count = self.values.get(label_values, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[label_values] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            samples = [(label_values, list(counts), total, count)
+                       for label_values, (counts, total, count) in self.values.items()]
+        for label_values, counts, total, count in samples:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{self.format_labels(label_values, ("le", bound))} {bucket_count}')
+            lines.append(f'{self.name}_bucket{self.format_labels(label_values, ("le", "+Inf"))} {count}')
+            lines.append(f'{self.name}_sum{self.format_labels(label_values)} {total}')
+            lines.append(f'{self.name}_count{self.format_labels(label_values)} {count}')
+        return lines
+
+
+REGISTRY = list()
+
+command_duration = Histogram('coins_command_duration_seconds', 'Time spent running a command', ['command'])
+db_statements = Counter('coins_db_statements_total', 'Statements sent to the database')
+db_statement_duration = Histogram('coins_db_statement_duration_seconds', 'Time spent executing a statement')
+db_pool_checkout = Histogram('coins_db_pool_checkout_seconds', 'Time spent waiting for a pooled connection')
+tick_duration = Histogram('coins_tick_duration_seconds', 'Time spent running the voice coins tick', ['guild'])
+gateway_latency = Gauge('coins_gateway_latency_seconds', 'Latency between a heartbeat and its acknowledgement')
+event_loop_lag = Gauge('coins_event_loop_lag_seconds', 'Delay of the event loop in running a scheduled callback')
+
+
+def render():
+    lines = list()
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def monitor_event_loop_lag(interval: float = 1.0):
+    """Measures how late the event loop wakes up from a sleep, a busy or blocked loop wakes up late."""
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.set(max(0.0, loop.time() - start - interval))
+
+
+class MetricsServer:
+    """Serves the metrics in the Prometheus text exposition format on /metrics."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_metrics(self, request):
+        return web.Response(body=render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
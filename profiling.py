@@ -0,0 +1,106 @@
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+SPAN_NAMES = ('db', 'render', 'discord')
+
+current_spans = contextvars.ContextVar('current_spans', default=None)
+
+
+@contextmanager
+def span(name: str):
+    """Adds the time spent in the block to the spans of the command being profiled, if there is one."""
+    spans = current_spans.get()
+    if spans is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans[name] = spans.get(name, 0.0) + time.perf_counter() - start
+
+
+def time_http_requests(http):
+    """Wraps the HTTP client of the bot so that every call to the Discord API is counted as a 'discord' span."""
+    request = http.request
+
+    async def timed_request(*args, **kwargs):
+        with span('discord'):
+            return await request(*args, **kwargs)
+    http.request = timed_request
+
+
+class Profiler:
+    """Opt-in profiling of the commands: while it is running every command is split in database, rendering,
+    Discord API and Python time, and the whole process is profiled with cProfile."""
+
+    def __init__(self, directory: str = 'logs'):
+        self.directory = directory
+        self.profile = None
+        self.started_at = None
+        self.commands = dict()
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        self.commands = dict()
+        self.started_at = datetime.now()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        """Stops profiling and writes the results, returns the paths of the cProfile dump and of the summary."""
+        self.profile.disable()
+        profile = self.profile
+        self.profile = None
+
+        name = os.path.join(self.directory, f'profile-{self.started_at:%Y%m%d-%H%M%S}')
+        profile.dump_stats(f'{name}.prof')
+        with open(f'{name}.txt', 'w', encoding='utf8') as summary:
+            summary.write(self.summary(profile))
+        logging.info('Profile written to %s.prof and %s.txt', name, name)
+        return f'{name}.prof', f'{name}.txt'
+
+    def begin_command(self, ctx):
+        if self.running:
+            ctx.profile_start = time.perf_counter()
+            current_spans.set(dict())
+
+    def end_command(self, ctx):
+        spans = current_spans.get()
+        start = getattr(ctx, 'profile_start', None)
+        if spans is None or start is None:
+            return
+        current_spans.set(None)
+
+        totals = self.commands.setdefault(ctx.command.qualified_name, dict.fromkeys(('count', 'total') + SPAN_NAMES, 0))
+        totals['count'] += 1
+        totals['total'] += time.perf_counter() - start
+        for span_name in SPAN_NAMES:
+            totals[span_name] += spans.get(span_name, 0.0)
+
+    def summary(self, profile):
+        lines = [f'Profile from {self.started_at:%Y-%m-%d %H:%M:%S} to {datetime.now():%Y-%m-%d %H:%M:%S}', '',
+                 'Average time per command in ms',
+                 f'{"command":24} {"count":>7} {"total":>9} {"db":>9} {"render":>9} {"discord":>9} {"python":>9}']
+        for command, totals in sorted(self.commands.items(), key=lambda item: item[1]['total'], reverse=True):
+            count = totals['count']
+            python = totals['total'] - sum(totals[span_name] for span_name in SPAN_NAMES)
+            lines.append(f'{command:24} {count:7d} {totals["total"] / count * 1000:9.2f}'
+                         + ''.join(f' {totals[span_name] / count * 1000:9.2f}' for span_name in SPAN_NAMES)
+                         + f' {python / count * 1000:9.2f}')
+
+        stats = io.StringIO()
+        pstats.Stats(profile, stream=stats).sort_stats('cumulative').print_stats(40)
+        lines += ['', stats.getvalue()]
+        return '\n'.join(lines)
@@ -0,0 +1,184 @@
+"""Exports the users and companies tables to files and loads them back, to back up the economy,
+move it to another host or seed a test environment. Run it with the bot stopped:
+
+    python snapshot.py export <directory> [--format jsonl|csv] [--config config.ini]
+    python snapshot.py import <directory> [--format jsonl|csv] [--replace] [--config config.ini]
+
+The export streams the rows with a server-side cursor, so it runs in constant memory. The import
+checks every file first, then writes chunks of rows with multi-row INSERTs in a single transaction,
+companies first since users reference them, and records the imported balances in the transactions ledger.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import timeit
+from datetime import datetime
+
+from sqlalchemy import exc, select, Boolean, Float, Integer
+
+from coins import Config
+from database import Database
+
+CHUNK_SIZE = 5000
+
+
+class OfflineBot:
+    """The part of the bot that Database needs."""
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+
+def tables(db):
+    # Companies first, users reference them
+    return [db.Company.__table__, db.User.__table__]
+
+
+def to_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def from_csv_value(column, value: str):
+    if value == '':
+        return None if column.nullable else column.type.python_type()
+    if isinstance(column.type, Boolean):
+        return value == '1'
+    if isinstance(column.type, Integer):
+        return int(value)
+    if isinstance(column.type, Float):
+        return float(value)
+    return value
+
+
+def export_table(db, table, path: str, file_format: str):
+    count = 0
+    with db.engine.connect() as conn, open(path, 'w', encoding='utf8', newline='') as file:
+        result = conn.execution_options(stream_results=True).execute(select([table]))
+        writer = None
+        if file_format == 'csv':
+            writer = csv.writer(file)
+            writer.writerow(table.c.keys())
+
+        rows = result.fetchmany(CHUNK_SIZE)
+        while rows:
+            for row in rows:
+                if writer is not None:
+                    writer.writerow([to_csv_value(value) for value in row])
+                else:
+                    file.write(json.dumps(dict(row), ensure_ascii=False) + '\n')
+            count += len(rows)
+            rows = result.fetchmany(CHUNK_SIZE)
+    return count
+
+
+def read_rows(table, path: str, file_format: str):
+    with open(path, encoding='utf8', newline='') as file:
+        if file_format == 'csv':
+            reader = csv.reader(file)
+            columns = [table.c[name] for name in next(reader)]
+            for values in reader:
+                yield {column.name: from_csv_value(column, value) for column, value in zip(columns, values)}
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def ledger_entries(table, rows: list, created_at: datetime):
+    if table.name == 'users':
+        return [{'created_at': created_at, 'member_id': row['member_id'], 'company_name': None,
+                 'amount': row['balance'], 'kind': 'set'} for row in rows]
+    return [{'created_at': created_at, 'member_id': None, 'company_name': row['name'],
+             'amount': row['balance'], 'kind': 'set'} for row in rows]
+
+
+def check_file(table, path: str, file_format: str):
+    """Reads the whole file and checks that every row parses and only has columns of the table,
+    returns the number of rows. Raises OSError or ValueError."""
+    count = 0
+    try:
+        for row in read_rows(table, path, file_format):
+            unknown = set(row) - set(table.c.keys())
+            if unknown:
+                raise ValueError(f'unknown columns {", ".join(sorted(unknown))}')
+            count += 1
+    except (KeyError, ValueError, csv.Error) as error:
+        raise ValueError(f'{path} is not a valid {file_format} export of {table.name}: {error}') from error
+    return count
+
+
+def import_table(db, conn, table, path: str, file_format: str, created_at: datetime):
+    transactions = db.Transaction.__table__
+    count = 0
+    chunk = list()
+    for row in read_rows(table, path, file_format):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            conn.execute(table.insert().values(chunk))
+            conn.execute(transactions.insert().values(ledger_entries(table, chunk, created_at)))
+            count += len(chunk)
+            chunk = list()
+    if chunk:
+        conn.execute(table.insert().values(chunk))
+        conn.execute(transactions.insert().values(ledger_entries(table, chunk, created_at)))
+        count += len(chunk)
+    return count
+
+
+def export_snapshot(db, directory: str, file_format: str):
+    os.makedirs(directory, exist_ok=True)
+    for table in tables(db):
+        start = timeit.default_timer()
+        count = export_table(db, table, os.path.join(directory, f'{table.name}.{file_format}'), file_format)
+        logging.info('Exported %d %s in %.2fs', count, table.name, timeit.default_timer() - start)
+
+
+def import_snapshot(db, directory: str, file_format: str, replace: bool):
+    """Imports the snapshot in a single transaction, so the database is left as it was if anything fails.
+    The files are checked before the transaction starts, a missing or malformed file deletes nothing."""
+    paths = {table.name: os.path.join(directory, f'{table.name}.{file_format}') for table in tables(db)}
+    for table in tables(db):
+        check_file(table, paths[table.name], file_format)
+
+    created_at = datetime.utcnow()
+    with db.engine.begin() as conn:
+        if replace:
+            for table in reversed(tables(db)):
+                conn.execute(table.delete())
+        for table in tables(db):
+            start = timeit.default_timer()
+            count = import_table(db, conn, table, paths[table.name], file_format, created_at)
+            logging.info('Imported %d %s in %.2fs', count, table.name, timeit.default_timer() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export or import the users and companies of the economy')
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('directory')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--replace', action='store_true', help='delete the current users and companies first')
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = Database(OfflineBot(Config().load(args.config)))
+    try:
+        if args.action == 'export':
+            export_snapshot(db, args.directory, args.format)
+        else:
+            try:
+                import_snapshot(db, args.directory, args.format, args.replace)
+            except (OSError, ValueError, exc.DBAPIError) as error:
+                raise SystemExit(f'Nothing was imported: {error}')
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
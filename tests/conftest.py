@@ -0,0 +1,45 @@
+import asyncio
+import os
+
+import pytest
+
+from coins import Config
+from cogs.economy import Economy
+from tests.fakes import FakeBot, FakeGuild
+
+CONFIG = os.path.join(os.path.dirname(__file__), '..', 'default_config.ini')
+COMPANY = 'test-company'
+RICH, POOR, NEW = 1, 2, 3
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    # Let the cancelled background loops of the cogs finish
+    loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop), return_exceptions=True))
+    loop.close()
+
+
+@pytest.fixture
+def economy(loop):
+    cfg = Config().load(CONFIG)
+    cfg['Database']['backend'] = 'memory'
+    guild = FakeGuild()
+    bot = FakeBot(cfg, [guild])
+
+    session = bot.db.Session()
+    session.add(bot.db.Company(name=COMPANY, tag='TEST', category_id=0, role=0, balance=100))
+    session.flush()
+    session.add(bot.db.User(member_id=RICH, balance=100, company_name=COMPANY))
+    session.add(bot.db.User(member_id=POOR, balance=1))
+    session.commit()
+    session.close()
+
+    async def start():
+        return Economy(bot)
+    economy = loop.run_until_complete(start())
+    economy.cog_unload()
+    yield economy
+    bot.db.close()
@@ -0,0 +1,54 @@
+"""Fake Discord objects that drive the cogs without a connection to Discord, shared by the tests
+and the benchmarks."""
+from types import SimpleNamespace
+
+from database import Database
+from messages import MessageCatalog
+
+
+class FakeBot:
+    def __init__(self, cfg, guilds):
+        self.cfg = cfg
+        self.guilds = guilds
+        self.messages = MessageCatalog(cfg['Messages'])
+        self.db = Database(self)
+
+    def get_message(self, message: str, *args):
+        return self.messages.render(message, *args)
+
+    def get_guild(self, guild_id: int):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def guild_cfg(self, guild_id: int, key: str):
+        return self.cfg[key]
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = 1):
+        self.id = guild_id
+        self.unavailable = False
+        self.voice_channels = list()
+        self.members = dict()
+
+    def get_member(self, member_id: int):
+        if member_id not in self.members:
+            self.members[member_id] = fake_member(self, member_id, [])
+        return self.members[member_id]
+
+
+def fake_member(guild, member_id: int, roles: list, voice=None):
+    return SimpleNamespace(id=member_id, guild=guild, display_name=f'member-{member_id}', roles=roles, voice=voice)
+
+
+def add_voice_channels(cfg, guild, members: int, per_channel: int = 10, first_id: int = 1):
+    """Puts members with ids from first_id in voice channels of the guild, every fifth member is self muted."""
+    role = SimpleNamespace(id=cfg['role'])
+    for start in range(0, members, per_channel):
+        channel = SimpleNamespace(id=len(guild.voice_channels) + 1, members=list())
+        for member_id in range(first_id + start, first_id + min(start + per_channel, members)):
+            voice = SimpleNamespace(channel=channel, afk=False, deaf=False, mute=False, self_deaf=False,
+                                    self_mute=(member_id - first_id) % 5 == 0)
+            member = fake_member(guild, member_id, [role], voice)
+            guild.members[member_id] = member
+            channel.members.append(member)
+        guild.voice_channels.append(channel)
@@ -0,0 +1,93 @@
+import random
+
+from leaderboard import Leaderboard
+
+
+def ranked(balances: dict, size: int):
+    return sorted(balances.items(), key=lambda entry: entry[1], reverse=True)[:size]
+
+
+def test_not_loaded_is_stale():
+    leaderboard = Leaderboard(3, 5)
+    leaderboard.update(1, 10)
+    assert leaderboard.top() is None
+
+
+def test_top_is_ordered_and_limited_to_size():
+    leaderboard = Leaderboard(3, 5)
+    leaderboard.load([(1, 50), (2, 40), (3, 30), (4, 20)])
+    assert leaderboard.complete
+    assert leaderboard.top() == [(1, 50), (2, 40), (3, 30)]
+
+    leaderboard.update(4, 45)
+    assert leaderboard.top() == [(1, 50), (4, 45), (2, 40)]
+
+
+def test_capacity_evicts_the_lowest_and_raises_the_floor():
+    leaderboard = Leaderboard(2, 3)
+    leaderboard.load([(1, 50), (2, 40), (3, 30)])
+    assert not leaderboard.complete
+    assert leaderboard.floor == 30
+
+    leaderboard.update(4, 35)
+    assert len(leaderboard.entries) == 3
+    assert 3 not in leaderboard.entries
+    assert leaderboard.floor == 30
+
+    # Not above the floor, someone that is not held could be richer
+    leaderboard.update(5, 30)
+    assert 5 not in leaderboard.entries
+
+
+def test_drop_below_the_floor_makes_it_stale():
+    leaderboard = Leaderboard(2, 3)
+    leaderboard.load([(1, 50), (2, 40), (3, 30)])
+
+    leaderboard.update(1, 10)
+    assert 1 not in leaderboard.entries
+    assert leaderboard.top() == [(2, 40), (3, 30)]
+
+    leaderboard.update(2, 0)
+    assert leaderboard.stale
+    assert leaderboard.top() is None
+
+
+def test_keep_filters_and_needs_enough_entries():
+    leaderboard = Leaderboard(2, 4)
+    leaderboard.load([(1, 50), (2, 40), (3, 30), (4, 20)])
+    assert leaderboard.top(lambda key: key % 2 == 0) == [(2, 40), (4, 20)]
+    # Only one even key held and balances below the floor are unknown
+    leaderboard.update(4, 5)
+    assert leaderboard.top(lambda key: key % 2 == 0) is None
+
+    complete = Leaderboard(2, 10)
+    complete.load([(1, 50), (2, 40)])
+    assert complete.top(lambda key: key == 2) == [(2, 40)]
+
+
+def test_load_after_an_update_is_refused():
+    leaderboard = Leaderboard(2, 3)
+    generation = leaderboard.generation
+    leaderboard.update(1, 100)
+    assert not leaderboard.load([(2, 40), (3, 30)], generation)
+    assert leaderboard.top() is None
+
+    assert leaderboard.load([(1, 100), (2, 40)], leaderboard.generation)
+    assert leaderboard.top() == [(1, 100), (2, 40)]
+
+
+def test_random_updates_match_a_full_ranking():
+    rng = random.Random(0)
+    balances = {key: rng.randrange(1000) for key in range(200)}
+    leaderboard = Leaderboard(10, 30)
+    leaderboard.load(ranked(balances, 30))
+
+    for _ in range(5000):
+        key = rng.randrange(250)
+        balances[key] = max(0, balances.get(key, 0) + rng.randint(-300, 300))
+        leaderboard.update(key, balances[key])
+        top = leaderboard.top()
+        if top is None:
+            leaderboard.load(ranked(balances, 30))
+            top = leaderboard.top()
+        assert [balance for _, balance in top] == [balance for _, balance in ranked(balances, 10)]
@@ -0,0 +1,33 @@
+from types import SimpleNamespace
+
+from tests.conftest import COMPANY
+
+
+def test_replay_does_not_depend_on_the_recording_order(loop, economy):
+    db = economy.bot.db
+    # A member that is not in the database yet, so that all its balance is in the ledger
+    member = SimpleNamespace(id=500)
+    loop.run_until_complete(economy.add_to_balance(member, 10))
+    loop.run_until_complete(economy.set_balance(member, 50))
+    loop.run_until_complete(economy.add_to_balance(member, 5))
+
+    # A tick that committed before the set can record its entry after it
+    db.ledger.entries.reverse()
+    count, replayed, current = db.replay_balance(member.id)
+    assert current == 55
+    assert replayed == current
+
+
+def test_set_balance_of_a_new_member(loop, economy):
+    db = economy.bot.db
+    loop.run_until_complete(economy.set_balance(SimpleNamespace(id=999), 30))
+    count, replayed, current = db.replay_balance(999)
+    assert (count, replayed, current) == (1, 30, 30)
+
+
+def test_set_company_balance_records_the_difference(loop, economy):
+    db = economy.bot.db
+    db.ledger.flush()
+    assert loop.run_until_complete(economy.set_company_balance(COMPANY, 40)) == 40
+    assert db.ledger.entries[-1]['amount'] == 40 - 100
+    assert loop.run_until_complete(economy.set_company_balance('missing', 40)) is None
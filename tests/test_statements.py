@@ -0,0 +1,61 @@
+"""Checks how many statements each accessor of the economy sends to the database, so a change that
+adds round trips to a command fails here. The limits are the ones of the SQLite backends, where an upsert
+is an INSERT OR IGNORE followed by an UPDATE; on MySQL it is a single statement."""
+import asyncio
+
+import pytest
+
+from cogs.companies import Companies
+from database import StatementCounter
+from tests.conftest import COMPANY, NEW, POOR, RICH
+
+ACCESSORS = [
+    ('get_user', 1, lambda economy, guild: economy.bot.db.get_user(RICH)),
+    ('get_company', 1, lambda economy, guild: economy.bot.db.get_company(COMPANY)),
+    ('load_profile', 1, lambda economy, guild: economy.bot.db.load_profile(RICH)),
+    ('get_balance', 1, lambda economy, guild: economy.get_balance(guild.get_member(RICH))),
+    ('get_balance of a new member', 1, lambda economy, guild: economy.get_balance(guild.get_member(NEW))),
+    ('get_company_balance', 1, lambda economy, guild: economy.get_company_balance(COMPANY)),
+    ('is_blacklisted', 1, lambda economy, guild: economy.is_blacklisted(guild.get_member(RICH))),
+    ('get_company_for', 1, lambda economy, guild: Companies(economy.bot).get_company_for(guild.get_member(RICH))),
+    ('set_balance', 4, lambda economy, guild: economy.set_balance(guild.get_member(RICH), 10)),
+    ('set_company_balance', 3, lambda economy, guild: economy.set_company_balance(COMPANY, 10)),
+    ('add_to_balance', 3, lambda economy, guild: economy.add_to_balance(guild.get_member(RICH), 10)),
+    ('add_to_balance of a new member', 3, lambda economy, guild: economy.add_to_balance(guild.get_member(NEW), 10)),
+    ('blacklist', 2, lambda economy, guild: economy.blacklist(guild.get_member(RICH))),
+    ('payment', 5, lambda economy, guild: economy.payment(guild.get_member(RICH), guild.get_member(POOR), 10)),
+    ('payment to a new member', 5,
+     lambda economy, guild: economy.payment(guild.get_member(RICH), guild.get_member(NEW), 10)),
+    ('payment without enough coins', 2,
+     lambda economy, guild: economy.payment(guild.get_member(POOR), guild.get_member(RICH), 10)),
+    ('company_deposit', 4, lambda economy, guild: economy.company_deposit(guild.get_member(RICH), 10)),
+    ('company_deposit without a company', 1, lambda economy, guild: economy.company_deposit(guild.get_member(POOR), 1)),
+    ('charge_balance', 2, lambda economy, guild: economy.charge_balance(RICH, 10, False)),
+    ('charge_balance without enough coins', 1, lambda economy, guild: economy.charge_balance(POOR, 10, False)),
+    ('charge_balance forced', 1, lambda economy, guild: economy.charge_balance(RICH, 10, True)),
+    ('charge_company_balance', 2, lambda economy, guild: economy.charge_company_balance(COMPANY, 10, False)),
+    ('company_top_donors', 1, lambda economy, guild: economy.company_top_donors(COMPANY)),
+]
+
+
+@pytest.mark.parametrize('limit, operation', [(limit, operation) for _, limit, operation in ACCESSORS],
+                         ids=[name for name, _, _ in ACCESSORS])
+def test_statement_limit(loop, economy, limit, operation):
+    guild = economy.bot.guilds[0]
+    with StatementCounter(economy.bot.db.engine) as counter:
+        result = operation(economy, guild)
+        if asyncio.iscoroutine(result):
+            loop.run_until_complete(result)
+    assert counter.count <= limit
+
+
+def test_cached_accessors_skip_the_database(loop, economy):
+    member = economy.bot.guilds[0].get_member(RICH)
+    loop.run_until_complete(economy.is_blacklisted(member))
+    loop.run_until_complete(economy.company_top_donors(COMPANY))
+
+    with StatementCounter(economy.bot.db.engine) as counter:
+        loop.run_until_complete(economy.is_blacklisted(member))
+        loop.run_until_complete(Companies(economy.bot).get_company_for(member))
+        loop.run_until_complete(economy.company_top_donors(COMPANY))
+    assert counter.count == 0
@@ -0,0 +1,21 @@
+from types import SimpleNamespace
+
+
+def test_failed_tick_does_not_raise(loop, economy, caplog):
+    async def fail(*args, **kwargs):
+        raise RuntimeError('database is gone')
+    economy.bulk_add_to_balance = fail
+
+    guild_id = economy.bot.guilds[0].id
+    loop.run_until_complete(economy.coins_tick(guild_id))
+    assert 'coins_tick of guild %d failed' % guild_id in caplog.text
+
+
+def test_stopped_tick_is_replaced(loop, economy):
+    guild_id = economy.bot.guilds[0].id
+    economy.guild_ticks[guild_id] = SimpleNamespace(is_running=lambda: False)
+
+    economy.start_guild_tick(guild_id)
+    tick = economy.guild_ticks[guild_id]
+    assert tick.is_running()
+    economy.stop_guild_tick(guild_id)
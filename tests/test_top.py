@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+
+from leaderboard import Leaderboard
+
+FIRST = 100
+
+
+def make_guild(member_ids):
+    members = {member_id: SimpleNamespace(id=member_id, display_name=f'member-{member_id}')
+               for member_id in member_ids}
+    return SimpleNamespace(id=2, get_member=members.get)
+
+
+def seed_users(economy, count: int):
+    session = economy.bot.db.Session()
+    for i in range(count):
+        session.add(economy.bot.db.User(member_id=FIRST + i, balance=1000 - i))
+    session.commit()
+    session.close()
+
+
+def test_top_only_shows_members_of_the_guild(loop, economy):
+    seed_users(economy, 50)
+    guild = make_guild([FIRST + 3, FIRST + 7, FIRST + 40])
+
+    embed = loop.run_until_complete(economy.top(guild))
+    assert len(embed.description.splitlines()) == 3
+    assert all(f'member-{member_id}' in embed.description for member_id in (FIRST + 3, FIRST + 7, FIRST + 40))
+
+
+def test_top_reads_the_database_past_the_leaderboard(loop, economy):
+    seed_users(economy, 50)
+    # Only the 10 richest are held, none of them is in the guild
+    economy.users_leaderboard = Leaderboard(10, 10)
+    loop.run_until_complete(economy.refresh_leaderboards())
+    member_ids = list(range(FIRST + 20, FIRST + 35))
+    guild = make_guild(member_ids)
+
+    embed = loop.run_until_complete(economy.top(guild))
+    lines = embed.description.splitlines()
+    assert len(lines) == 10
+    for line, member_id in zip(lines, member_ids):
+        assert f'member-{member_id}' in line
+
+
+def test_refresh_does_not_load_rows_read_before_an_update(economy):
+    seed_users(economy, 20)
+    fetch = economy.fetch_top_rows
+
+    def fetch_then_pay(model, key_column, limit):
+        rows = fetch(model, key_column, limit)
+        # A payment credits a member right after the first read of the users
+        if model is economy.user_model and economy.fetch_top_rows is fetch_then_pay:
+            economy.fetch_top_rows = fetch
+            economy.add_to_balance.__wrapped__(economy, SimpleNamespace(id=FIRST + 19), 5000)
+        return rows
+    economy.fetch_top_rows = fetch_then_pay
+
+    # The blocking bodies run directly, as on a database worker
+    economy.refresh_leaderboards.__wrapped__(economy)
+    assert economy.users_leaderboard.top()[0] == (FIRST + 19, 5000 + 1000 - 19)
@@ -0,0 +1,24 @@
+from tests.conftest import COMPANY, RICH
+
+
+def test_deposit_during_fetch_is_not_cached(loop, economy):
+    member = economy.bot.guilds[0].get_member(RICH)
+    fetch = economy.fetch_company_top_donors
+
+    async def fetch_then_deposit(company_name: str):
+        top_donors = await fetch(company_name)
+        await economy.company_deposit(member, 10)
+        return top_donors
+    economy.fetch_company_top_donors = fetch_then_deposit
+
+    assert loop.run_until_complete(economy.company_top_donors(COMPANY)) == []
+    economy.fetch_company_top_donors = fetch
+    assert loop.run_until_complete(economy.company_top_donors(COMPANY)) == [(RICH, 10)]
+
+
+def test_refresh_drops_every_company(loop, economy):
+    loop.run_until_complete(economy.company_top_donors(COMPANY))
+    assert COMPANY in economy.top_donors
+
+    loop.run_until_complete(economy.refresh_leaderboards())
+    assert len(economy.top_donors) == 0
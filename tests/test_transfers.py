@@ -0,0 +1,64 @@
+"""Fires concurrent payments and deposits at an SQLite file and checks that no coin is created or destroyed
+and that no balance goes negative."""
+import random
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from coins import Config
+from database import Database
+from tests.conftest import COMPANY, CONFIG
+
+MEMBERS = 50
+BALANCE = 100
+TRANSFERS = 2000
+THREADS = 16
+
+
+@pytest.fixture
+def db(tmp_path):
+    cfg = Config().load(CONFIG)
+    cfg['Database']['backend'] = 'sqlite'
+    cfg['Database']['path'] = str(tmp_path / 'coins.db')
+    db = Database(SimpleNamespace(cfg=cfg))
+
+    session = db.Session()
+    session.add(db.Company(name=COMPANY, tag='TEST', category_id=0, role=0, balance=0))
+    session.flush()
+    for member_id in range(MEMBERS):
+        session.add(db.User(member_id=member_id, balance=BALANCE,
+                            company_name=COMPANY if member_id % 2 == 0 else None))
+    session.commit()
+    session.close()
+    yield db
+    db.close()
+
+
+def totals(db):
+    session = db.Session()
+    balances = [user.balance for user in session.query(db.User).all()]
+    company = session.query(db.Company).get(COMPANY)
+    result = sum(balances), min(balances), company.balance
+    session.close()
+    return result
+
+
+def test_concurrent_transfers_conserve_coins(db):
+    rng = random.Random(0)
+    operations = list()
+    for _ in range(TRANSFERS):
+        sender = rng.randrange(MEMBERS)
+        amount = rng.randint(1, BALANCE // 2)
+        if rng.random() < 0.2:
+            operations.append((db.deposit, sender, amount))
+        else:
+            operations.append((db.transfer, sender, rng.randrange(MEMBERS), amount))
+
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        results = list(pool.map(lambda operation: operation[0](*operation[1:]), operations))
+
+    users_total, lowest, company_total = totals(db)
+    assert any(result is not None for result in results)
+    assert users_total + company_total == MEMBERS * BALANCE
+    assert lowest >= 0
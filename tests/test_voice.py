@@ -0,0 +1,75 @@
+import random
+from types import SimpleNamespace
+
+from tests.fakes import FakeGuild, add_voice_channels, fake_member
+from voice import VoiceIndex
+
+ROLE = 42
+
+
+def make_guild(guild_id: int = 1, members: int = 50):
+    guild = FakeGuild(guild_id)
+    add_voice_channels({'role': ROLE}, guild, members)
+    return guild
+
+
+def move(member, channel):
+    """Moves the member to channel, None disconnects it from voice."""
+    if member.voice.channel is not None:
+        member.voice.channel.members.remove(member)
+    member.voice.channel = channel
+    if channel is not None:
+        channel.members.append(member)
+
+
+def test_rebuild_matches_scan():
+    guilds = [make_guild(1), make_guild(2, 23)]
+    index = VoiceIndex(lambda guild_id: ROLE)
+    index.rebuild(guilds)
+
+    assert index.verify(guilds)
+    # Every fifth member is self muted
+    assert sum(len(members) for members in index.channels(1)) == 40
+
+
+def test_updates_match_scan():
+    guild = make_guild()
+    index = VoiceIndex(lambda guild_id: ROLE)
+    index.rebuild([guild])
+
+    rng = random.Random(0)
+    members = list(guild.members.values())
+    for _ in range(2000):
+        member = rng.choice(members)
+        change = rng.randrange(4)
+        if change == 0:
+            member.voice.self_mute = not member.voice.self_mute
+        elif change == 1:
+            move(member, rng.choice(guild.voice_channels + [None]))
+        elif change == 2:
+            member.roles = [] if member.roles else [SimpleNamespace(id=ROLE)]
+        else:
+            member.voice.afk = not member.voice.afk
+        index.update(member)
+        assert index.verify([guild])
+
+
+def test_member_without_voice_is_not_indexed():
+    guild = make_guild()
+    index = VoiceIndex(lambda guild_id: ROLE)
+    index.rebuild([guild])
+
+    member = fake_member(guild, 0, [SimpleNamespace(id=ROLE)])
+    index.update(member)
+    assert index.verify([guild])
+
+
+def test_remove_guild():
+    guilds = [make_guild(1), make_guild(2)]
+    index = VoiceIndex(lambda guild_id: ROLE)
+    index.rebuild(guilds)
+
+    index.remove_guild(1)
+    assert len(index.channels(1)) == 0
+    assert index.verify(guilds[1:])
+    assert all(guild_id == 2 for guild_id, _ in index.locations)
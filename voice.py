@@ -0,0 +1,66 @@
+import discord
+
+
+class VoiceIndex:
+    """Members eligible for the voice coins, grouped by guild and voice channel.
+
+    It is built with a full scan and then kept up to date with the voice state and member update events,
+    so that the coins tick only has to look at the eligible members."""
+
+    def __init__(self, role_for):
+        """role_for returns the id of the role needed to earn coins in a guild, given the guild id."""
+        self.role_for = role_for
+        self.guilds = dict()
+        self.locations = dict()
+
+    def is_eligible(self, member: discord.Member):
+        v = member.voice
+        return (v is not None and v.channel is not None and not v.afk
+                and not (v.deaf or v.mute or v.self_deaf or v.self_mute)
+                and discord.utils.get(member.roles, id=self.role_for(member.guild.id)) is not None)
+
+    def update(self, member: discord.Member):
+        key = (member.guild.id, member.id)
+        old_channel_id = self.locations.pop(key, None)
+        if old_channel_id is not None:
+            channels = self.guilds[member.guild.id]
+            channels[old_channel_id].discard(member.id)
+            if len(channels[old_channel_id]) == 0:
+                del channels[old_channel_id]
+                if len(channels) == 0:
+                    del self.guilds[member.guild.id]
+
+        if self.is_eligible(member):
+            channel_id = member.voice.channel.id
+            self.guilds.setdefault(member.guild.id, dict()).setdefault(channel_id, set()).add(member.id)
+            self.locations[key] = channel_id
+
+    def remove_guild(self, guild_id: int):
+        for channel_members in self.guilds.pop(guild_id, dict()).values():
+            for member_id in channel_members:
+                self.locations.pop((guild_id, member_id), None)
+
+    def channels(self, guild_id: int):
+        """Returns the sets of eligible member ids of every voice channel of the guild that has any."""
+        return self.guilds.get(guild_id, dict()).values()
+
+    def rebuild(self, guilds):
+        self.guilds = self.scan(guilds)
+        self.locations = {(guild_id, member_id): channel_id
+                          for guild_id, channels in self.guilds.items()
+                          for channel_id, channel_members in channels.items()
+                          for member_id in channel_members}
+
+    def scan(self, guilds):
+        """Computes the eligible members of the guilds from scratch, in the same structure as the index."""
+        result = dict()
+        for guild in guilds:
+            for channel in guild.voice_channels:
+                eligible = {member.id for member in channel.members if self.is_eligible(member)}
+                if len(eligible) != 0:
+                    result.setdefault(guild.id, dict())[channel.id] = eligible
+        return result
+
+    def verify(self, guilds):
+        """Returns True if the index matches a full scan of the guilds."""
+        return self.guilds == self.scan(guilds)